@@ -0,0 +1,218 @@
+"""JSON API for Warbler's feeds and user lists.
+
+These mirror the HTML pages:
+
+    GET /api/timeline                 homepage (logged in)
+    GET /api/users/<id>               users_show: profile and messages
+    GET /api/users/<id>/following     show_following (logged in)
+    GET /api/users/<id>/followers     users_followers (logged in)
+    GET /api/users/<id>/likes         users_likes (logged in)
+
+Rows are read as plain column tuples rather than ORM objects, so nothing
+goes through the session's identity map, and only the columns asked for
+are selected. Pick them with a `fields` param, e.g.
+`/api/timeline?fields=id,text,username`; see MESSAGE_FIELDS and
+USER_FIELDS for what's available.
+
+Message lists are paged with a `before` cursor and user lists with an
+`after` cursor, as on the HTML pages (see pagination.py); each response
+includes `next_cursor`, which is null on the last page.
+"""
+
+import json
+
+from flask import Blueprint, g, request
+
+from models import db, User, Message, Follows, Likes
+from pagination import (paginate_users, page_query, page_of,
+                        encode_message_cursor, MESSAGES_PAGE_SIZE)
+from timeline import iter_home_timeline, message_query
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'image_url': User.image_url,
+}
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}
+
+
+class BadFields(Exception):
+    """Raised for a `fields` param naming fields that don't exist."""
+
+
+def to_json(data, status=200):
+    """Return a compact JSON response, encoded with orjson if it's installed."""
+
+    if orjson:
+        body = orjson.dumps(data)
+    else:
+        body = json.dumps(data, separators=(',', ':'),
+                          default=lambda value: value.isoformat())
+
+    return body, status, {'Content-Type': 'application/json'}
+
+
+def get_fields(available, required):
+    """Return the field names asked for in the `fields` param, in order.
+
+    Defaults to every field in `available`. `required` fields (needed for
+    ordering and cursors) are selected too, but only returned if asked for.
+    """
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else list(available)
+
+    unknown = [field for field in fields if field not in available]
+
+    if unknown:
+        raise BadFields(unknown)
+
+    selected = fields + [field for field in required if field not in fields]
+
+    return fields, [available[field].label(field) for field in selected]
+
+
+def to_dicts(rows, fields):
+    """Return `rows` as dicts of just `fields`."""
+
+    return [{field: getattr(row, field) for field in fields} for row in rows]
+
+
+@api.errorhandler(BadFields)
+def bad_fields(error):
+    """Say which requested fields don't exist."""
+
+    return to_json({'error': 'unknown fields', 'fields': error.args[0]}, 400)
+
+
+@api.before_request
+def require_login():
+    """Refuse anonymous requests, except for public profiles."""
+
+    if not g.user and request.endpoint != 'api.users_show':
+        return to_json({'error': 'login required'}, 401)
+
+
+def get_user_row(user_id, columns):
+    """Return a row of `columns` for `user_id`, or None."""
+
+    return db.session.query(*columns).filter(User.id == user_id).first()
+
+
+def messages_page(query):
+    """Return (rows, next_cursor) for a page of a projected message query."""
+
+    rows = page_query(query, Message.timestamp, Message.id,
+                      before=request.args.get('before')).all()
+
+    return page_of(rows, MESSAGES_PAGE_SIZE, encode_message_cursor)
+
+
+def users_page(query, id_col, fields):
+    """Return the JSON response for a page of a projected user query."""
+
+    rows, next_cursor = paginate_users(query, id_col,
+                                       after=request.args.get('after'))
+
+    return to_json({'users': to_dicts(rows, fields),
+                    'next_cursor': next_cursor})
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home timeline."""
+
+    fields, columns = get_fields(MESSAGE_FIELDS, ('id', 'timestamp'))
+
+    rows = list(iter_home_timeline(g.user,
+                                   before=request.args.get('before'),
+                                   columns=columns))
+    rows, next_cursor = page_of(rows, MESSAGES_PAGE_SIZE, encode_message_cursor)
+
+    return to_json({'messages': to_dicts(rows, fields),
+                    'next_cursor': next_cursor})
+
+
+@api.route('/users/<int:user_id>')
+def users_show(user_id):
+    """A user's profile and messages, newest first."""
+
+    fields, columns = get_fields(MESSAGE_FIELDS, ('id', 'timestamp'))
+
+    user = get_user_row(user_id, [column.label(name)
+                                  for name, column in USER_FIELDS.items()])
+
+    if user is None:
+        return to_json({'error': 'not found'}, 404)
+
+    rows, next_cursor = messages_page(
+        message_query(columns).filter(Message.user_id == user_id))
+
+    return to_json({'user': user._asdict(),
+                    'messages': to_dicts(rows, fields),
+                    'next_cursor': next_cursor})
+
+
+@api.route('/users/<int:user_id>/following')
+def show_following(user_id):
+    """The users this user follows, in id order."""
+
+    fields, columns = get_fields(USER_FIELDS, ('id',))
+
+    following = (db.session
+                 .query(*columns)
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+
+    return users_page(following, Follows.user_being_followed_id, fields)
+
+
+@api.route('/users/<int:user_id>/followers')
+def users_followers(user_id):
+    """The users following this user, in id order."""
+
+    fields, columns = get_fields(USER_FIELDS, ('id',))
+
+    followers = (db.session
+                 .query(*columns)
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
+
+    return users_page(followers, Follows.user_following_id, fields)
+
+
+@api.route('/users/<int:user_id>/likes')
+def users_likes(user_id):
+    """The messages this user has liked, newest first."""
+
+    fields, columns = get_fields(MESSAGE_FIELDS, ('id', 'timestamp'))
+
+    rows, next_cursor = messages_page(
+        message_query(columns)
+        .join(Likes, Likes.message_id == Message.id)
+        .filter(Likes.user_id == user_id))
+
+    return to_json({'messages': to_dicts(rows, fields),
+                    'next_cursor': next_cursor})
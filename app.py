@@ -1,11 +1,37 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, jsonify, Response, stream_with_context,
+                   get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError
+from sqlalchemy.orm import joinedload, defer
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, UserCard, Message, Likes, Follows
+from timeline import (fan_out_message, remove_message, backfill_timeline,
+                      purge_timeline, iter_home_timeline, rebuild_timelines,
+                      stats as timeline_stats)
+from counters import adjust_counts, recount, get_related_user_ids
+from pagination import (paginate_messages, paginate_users, StreamedPage,
+                        encode_message_cursor, MESSAGES_PAGE_SIZE)
+from indexes import (add_missing_columns, rekey_likes, create_missing_indexes,
+                     find_seq_scans, NoSampleData)
+from search import search_users, search_messages, create_search_indexes
+from instrumentation import (init_instrumentation, get_route_metrics,
+                             require_metrics_access)
+from user_cache import get_current_user, invalidate_user
+from passwords import password_hasher, PasswordHasherBusy, get_default_workers
+from ratelimit import login_limiter, stats as rate_limit_stats
+from fragments import (message_card, invalidate_message, invalidate_author,
+                       stats as fragment_stats)
+from httpcache import static_url, make_etag, conditional_page, add_cache_headers
+from api import api
+from dbpool import (init_pool, get_pool_status, is_statement_timeout,
+                    stats as pool_stats)
+from replicas import init_replicas, get_replica_binds, stats as replica_stats
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +42,104 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Read-only requests go to these replicas, if any (see replicas.py), except
+# for REPLICA_LAG_SECONDS after the user writes something
+app.config['REPLICA_LAG_SECONDS'] = float(
+    os.environ.get('REPLICA_LAG_SECONDS', 5))
+app.config['REPLICA_BINDS'] = []
+app.config['SQLALCHEMY_BINDS'] = {}
+
+for i, url in enumerate(filter(None, os.environ.get(
+        'DATABASE_REPLICA_URLS', '').split(','))):
+    app.config['REPLICA_BINDS'].append(f'replica{i}')
+    app.config['SQLALCHEMY_BINDS'][f'replica{i}'] = url.strip()
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Bearer token for /metrics, /timeline/stats and /pool/stats; without it
+# (and outside debug mode) they're a 404
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Accounts with at least this many followers aren't fanned out to follower
+# timelines on write; their messages are merged in when timelines are read.
+app.config['TIMELINE_CELEBRITY_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_CELEBRITY_THRESHOLD', 10000))
+
+# Seconds the logged-in user's profile fields are cached between requests
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 10))
+
+# Send the homepage as it's rendered, fetching timeline rows in batches of
+# HOMEPAGE_STREAM_BATCH_SIZE, so the page starts arriving before the whole
+# timeline has been read. (Statements run while streaming happen after the
+# request's SQL log is written, so /metrics won't count them.)
+app.config['STREAM_HOMEPAGE'] = os.environ.get('STREAM_HOMEPAGE') == '1'
+app.config['HOMEPAGE_STREAM_BATCH_SIZE'] = 20
+
+# Most rendered message cards kept in memory (see fragments.py)
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+
+# bcrypt cost and the thread pool that hashes passwords (see passwords.py).
+# Existing hashes are upgraded to a new cost as their users log in. Set
+# WEB_CONCURRENCY to the number of web processes so that by default they
+# split the CPUs between their pools.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', get_default_workers()))
+app.config['PASSWORD_HASH_MAX_PENDING'] = int(
+    os.environ.get('PASSWORD_HASH_MAX_PENDING',
+                   4 * max(app.config['PASSWORD_HASH_WORKERS'], 1)))
+
+# Share login rate limits between processes by setting this to "database"
+# (see ratelimit.py)
+app.config['RATE_LIMIT_STORE'] = os.environ.get('RATE_LIMIT_STORE', 'memory')
+
+# Login rate limits are per client IP. Behind proxies (a load balancer,
+# nginx), set this to how many of them are in front of the app, so the
+# client's IP is taken from X-Forwarded-For. Leave it at 0 otherwise, or
+# clients could pick their own IP, and with it a fresh bucket.
+app.config['TRUSTED_PROXY_HOPS'] = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+
+# Database connection pool (see dbpool.py). Set DB_EXTERNAL_POOLER=1 when
+# connecting through PgBouncer or another transaction pooler.
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') == '1'
+app.config['DB_EXTERNAL_POOLER'] = os.environ.get('DB_EXTERNAL_POOLER') == '1'
+
+# Milliseconds a request's statements may run before they're cancelled
+# (0 for no limit), and longer limits for routes known to be slow
+app.config['STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('STATEMENT_TIMEOUT_MS', 5000))
+app.config['STATEMENT_TIMEOUTS'] = {
+    'list_users': 10000,
+    'messages_search': 10000,
+}
 toolbar = DebugToolbarExtension(app)
 
+if app.config['TRUSTED_PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=app.config['TRUSTED_PROXY_HOPS'],
+                            x_proto=app.config['TRUSTED_PROXY_HOPS'])
+
 connect_db(app)
+password_hasher.init_app(app)
+login_limiter.init_app(app)
+
+# registered first, so its before_request hook sees every query
+init_instrumentation(app)
+init_pool()
+
+# before anything else reads from the database
+init_replicas(app)
+
+# JSON versions of the feeds and user lists (see api.py)
+app.register_blueprint(api)
 
 
 ##############################################################################
@@ -31,15 +148,88 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    This is a CachedUser (see user_cache.py), which usually needs no query.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = get_current_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
 
+def get_following_ids():
+    """Return ids of users the current user follows, loaded once per request."""
+
+    if 'following_ids' not in g:
+        g.following_ids = g.user.get_following_ids() if g.user else set()
+
+    return g.following_ids
+
+
+def get_liked_message_ids():
+    """Return ids of messages the current user likes, loaded once per request."""
+
+    if 'liked_message_ids' not in g:
+        g.liked_message_ids = (g.user.get_liked_message_ids() if g.user
+                               else set())
+
+    return g.liked_message_ids
+
+
+def check_following(user_ids):
+    """Find out in one query which of `user_ids` the current user follows.
+
+    is_following() then answers for those users from the result, rather
+    than loading the id of everyone the current user follows. Use it for
+    pages of users, since the current user may follow many more.
+    """
+
+    if not g.user or 'following_ids' in g:
+        return
+
+    checked = g.setdefault('following_checked', {})
+    user_ids = [user_id for user_id in user_ids if user_id not in checked]
+    followed = g.user.get_following_ids(among=user_ids)
+
+    checked.update((user_id, user_id in followed) for user_id in user_ids)
+
+
+def is_following(user):
+    """Does the current user follow `user`?"""
+
+    checked = g.get('following_checked', {})
+
+    if user.id in checked:
+        return checked[user.id]
+
+    return user.id in get_following_ids()
+
+
+@app.context_processor
+def add_membership_checks():
+    """Let templates check follows and likes without loading collections.
+
+    Each listed user or message is then checked against a set of ids
+    fetched at most once per request (or, for users, against the batch
+    looked up by check_following).
+    """
+
+    return dict(
+        is_following=is_following,
+        has_liked=lambda message: message.id in get_liked_message_ids(),
+    )
+
+
+# the viewer-independent part of a message in a feed (see fragments.py)
+app.add_template_global(message_card)
+
+# links to static files that can be cached for good (see httpcache.py)
+app.add_template_global(static_url)
+
+
 def do_login(user):
     """Log in user."""
 
@@ -96,10 +286,22 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        if not login_limiter.allow(ip=request.remote_addr,
+                                   username=form.username.data.lower()):
+            flash("Too many login attempts; please try again later.", 'danger')
+            return render_template('users/login.html', form=form), 429
+
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
         if user:
+            # only failed attempts count against the limits
+            login_limiter.refund(ip=request.remote_addr,
+                                 username=form.username.data.lower())
+
+            # saves the password hash if it was just upgraded
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -109,6 +311,38 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Ask the client to retry when too many passwords are being checked."""
+
+    return ("Too many logins right now; please try again shortly.", 503,
+            {'Retry-After': '1'})
+
+
+@app.errorhandler(TimeoutError)
+def database_busy(error):
+    """Ask the client to retry when no database connection came free."""
+
+    pool_stats['exhausted'] += 1
+
+    return ("The site is busy right now; please try again shortly.", 503,
+            {'Retry-After': '1'})
+
+
+@app.errorhandler(OperationalError)
+def database_error(error):
+    """Answer a statement that ran past the route's timeout with a 503."""
+
+    if not is_statement_timeout(error):
+        raise error
+
+    db.session.rollback()
+    pool_stats['statement_timeouts'] += 1
+
+    return ("That took too long; please try again shortly.", 503,
+            {'Retry-After': '1'})
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -127,70 +361,158 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location (best matches first, paged with a 'page' param). Otherwise
+    lists everyone in id order, paged with an 'after' param (a user id).
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        rows, next_cursor = paginate_users(UserCard.query(), User.id,
+                                           after=request.args.get('after'))
+
+        return render_template('users/index.html',
+                               users=UserCard.from_rows(rows),
+                               next_cursor=next_cursor)
+
+    page = request.args.get('page', 1, type=int)
+    users, next_page = search_users(search, page=max(page, 1))
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search,
+                           next_page=next_page)
+
+
+# what users/detail.html shows of a user, for users_show's ETag
+USER_PAGE_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio',
+                    'location', 'messages_count', 'following_count',
+                    'followers_count', 'likes_count')
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Takes a 'before' param (see pagination.py) to show older messages.
+    """
 
     user = User.query.get_or_404(user_id)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # the page changes when the profile or counts do, or a message is posted
+    newest_message_id = (db.session
+                         .query(Message.id)
+                         .filter(Message.user_id == user_id)
+                         .order_by(Message.timestamp.desc(), Message.id.desc())
+                         .limit(1)
+                         .scalar())
+
+    # only asks about this user, not everyone the current user follows
+    check_following([user.id])
+
+    etag = make_etag(*(getattr(user, field) for field in USER_PAGE_FIELDS),
+                     newest_message_id,
+                     g.user and is_following(user))
+
+    def render():
+        # snagging messages in order from the database;
+        # user.messages won't be in order by default
+        messages, next_cursor = paginate_messages(
+            Message.query.filter(Message.user_id == user_id),
+            Message.timestamp,
+            Message.id,
+            before=request.args.get('before'))
+
+        return render_template('users/show.html', user=user,
+                               messages=messages, next_cursor=next_cursor)
+
+    return conditional_page(etag, render)
 
 
 @app.route('/users/<int:user_id>/following')
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
+
+    Takes an 'after' param (a user id) to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.query.options(defer(User.password)).get_or_404(user_id)
+
+    # keyset over the (user_following_id, user_being_followed_id) index
+    rows, next_cursor = paginate_users(
+        (UserCard
+         .query()
+         .join(Follows, Follows.user_being_followed_id == User.id)
+         .filter(Follows.user_following_id == user_id)),
+        Follows.user_being_followed_id,
+        after=request.args.get('after'))
+
+    following = UserCard.from_rows(rows)
+    check_following([user.id] + [followed.id for followed in following])
+
+    return render_template('users/following.html', user=user,
+                           following=following, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
+
+    Takes an 'after' param (a user id) to show the next page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.query.options(defer(User.password)).get_or_404(user_id)
+
+    # keyset over the follows primary key
+    rows, next_cursor = paginate_users(
+        (UserCard
+         .query()
+         .join(Follows, Follows.user_following_id == User.id)
+         .filter(Follows.user_being_followed_id == user_id)),
+        Follows.user_following_id,
+        after=request.args.get('after'))
+
+    followers = UserCard.from_rows(rows)
+    check_following([user.id] + [follower.id for follower in followers])
+
+    return render_template('users/followers.html', user=user,
+                           followers=followers, next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/likes')
 def users_likes(user_id):
-    """Show list of likes for this user."""
+    """Show list of likes for this user.
+
+    Takes a 'before' param (see pagination.py) to show older messages.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/likes.html', user=user)
+
+    liked = (Message
+             .query
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id)
+             .options(joinedload(Message.user)))
+
+    messages, next_cursor = paginate_messages(
+        liked,
+        Message.timestamp,
+        Message.id,
+        before=request.args.get('before'))
+
+    return render_template('users/likes.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
@@ -202,6 +524,10 @@ def add_follow(follow_id):
 
     followed_user = User.query.get_or_404(follow_id)
     g.user.following.append(followed_user)
+    db.session.flush()
+    backfill_timeline(g.user.id, followed_user.id)
+    adjust_counts(g.user.id, following_count=1)
+    adjust_counts(followed_user.id, followers_count=1)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -217,6 +543,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    purge_timeline(g.user.id, followed_user.id)
+    adjust_counts(g.user.id, following_count=-1)
+    adjust_counts(followed_user.id, followers_count=-1)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -235,15 +564,27 @@ def profile():
     if form.validate_on_submit():
         username = form.username.data
         password = form.password.data
+
+        if not login_limiter.allow(ip=request.remote_addr,
+                                   username=username.lower()):
+            flash("Too many password attempts; please try again later.", "danger")
+            return redirect('/')
+
         user = User.authenticate(username, password)
         if user:
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data
-            g.user.header_image_url = form.header_image_url.data
-            g.user.bio = form.bio.data
+            login_limiter.refund(ip=request.remote_addr,
+                                 username=username.lower())
+
+            user = g.user.load()
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data
+            user.header_image_url = form.header_image_url.data
+            user.bio = form.bio.data
 
             db.session.commit()
+            invalidate_user(user.id)
+            invalidate_author(user.id)
 
             flash("Updated.", "info")
             return redirect(f"/users/{g.user.id}")
@@ -264,8 +605,14 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = g.user.load()
+    related_user_ids = get_related_user_ids(user)
+
+    db.session.delete(user)
+    db.session.flush()
+    recount(related_user_ids)
     db.session.commit()
+    invalidate_user(user.id, *related_user_ids)
 
     return redirect("/signup")
 
@@ -278,15 +625,12 @@ def like_message(message_id):
         flash("Must be logged in.", "warning")
         return redirect("/login")
 
-    if message_id not in [like.id for like in g.user.likes]:
-        like = Likes(user_id=g.user.id, message_id=message_id)
-        db.session.add(like)
-        db.session.commit()
+    liked = Likes.toggle(g.user.id, message_id)
 
-    else:
-        like = Likes.query.filter(Likes.user_id==g.user.id,Likes.message_id==message_id).first()
-        db.session.delete(like)
-        db.session.commit()        
+    if liked:
+        adjust_counts(g.user.id, likes_count=liked)
+
+    db.session.commit()
 
     return redirect('/')
 
@@ -309,6 +653,9 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        fan_out_message(msg)
+        adjust_counts(g.user.id, messages_count=1)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -316,12 +663,40 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param; each of its words matches message words starting
+    with it. Newest matches come first, and a 'before' param (see
+    pagination.py) shows older ones.
+    """
+
+    search = request.args.get('q', '')
+
+    messages, next_cursor = search_messages(
+        search, before=request.args.get('before'))
+
+    return render_template('messages/search.html', search=search,
+                           messages=messages, next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message
+           .query
+           .options(joinedload(Message.user))
+           .get_or_404(message_id))
+
+    check_following([msg.user_id])
+
+    etag = make_etag(msg.id, msg.user.username, msg.user.image_url,
+                     g.user and is_following(msg.user))
+
+    return conditional_page(
+        etag, lambda: render_template('messages/show.html', message=msg))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -333,8 +708,18 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    remove_message(msg)
+
+    # likes of this message are deleted along with it
+    likers = (db.session
+              .query(Likes.user_id)
+              .filter(Likes.message_id == msg.id))
+    adjust_counts(likers, likes_count=-1)
+    adjust_counts(msg.user_id, messages_count=-1)
+
     db.session.delete(msg)
     db.session.commit()
+    invalidate_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -348,22 +733,28 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, read from
+      the user's precomputed timeline (see timeline.py); a 'before' param
+      shows older messages
+
+    With STREAM_HOMEPAGE set, the page is sent as it's rendered.
     """
 
     if g.user:
-        #gather user ids for followed users
-        user_ids_for_messages =[u.id for u in g.user.following]
+        streaming = app.config['STREAM_HOMEPAGE']
 
-        #add user id to list
-        user_ids_for_messages.append(g.user.id)
+        # rows are read as the template reaches them
+        messages = StreamedPage(
+            iter_home_timeline(
+                g.user,
+                before=request.args.get('before'),
+                batch_size=(streaming
+                            and app.config['HOMEPAGE_STREAM_BATCH_SIZE'])),
+            MESSAGES_PAGE_SIZE,
+            encode_message_cursor)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(user_ids_for_messages))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        if streaming:
+            return stream_template('home.html', messages=messages)
 
         return render_template('home.html', messages=messages)
 
@@ -371,19 +762,157 @@ def homepage():
         return render_template('home-anon.html')
 
 
+def stream_template(template_name, **context):
+    """Return a response that renders a template as it's sent."""
+
+    # the session is saved before the body is sent, so take any flashed
+    # messages out of it now rather than while rendering
+    get_flashed_messages()
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+
+    # send a few chunks at a time, rather than one per template statement
+    stream.enable_buffering(5)
+
+    return Response(stream_with_context(stream))
+
+
+@app.route('/timeline/stats')
+@require_metrics_access
+def show_timeline_stats():
+    """Show this process's timeline counters as JSON.
+
+    `merged_reads` counts homepage reads that had to merge in celebrity
+    messages at read time.
+    """
+
+    return jsonify(timeline_stats)
+
+
+@app.route('/metrics')
+@require_metrics_access
+def show_metrics():
+    """Show this process's per-route SQL totals and other counters as JSON.
+
+    `n_plus_one_requests` counts requests that ran the same statement
+    repeatedly (see instrumentation.py). `rate_limits` counts login attempts
+    checked and refused (see ratelimit.py), and `fragments` counts message
+    card cache hits and misses (see fragments.py). `replicas` counts requests
+    served by the primary and by replicas (see replicas.py).
+    """
+
+    return jsonify(routes=get_route_metrics(),
+                   timeline=timeline_stats,
+                   rate_limits=rate_limit_stats,
+                   fragments=fragment_stats,
+                   replicas=replica_stats)
+
+
+@app.route('/pool/stats')
+@require_metrics_access
+def show_pool_stats():
+    """Show the database connection pools' occupancy and counters as JSON.
+
+    The counters cover every pool in this process, replicas' included. With
+    DB_EXTERNAL_POOLER there's no pool to show, just the counters; ask the
+    pooler itself (e.g. PgBouncer's SHOW POOLS) for its occupancy.
+    """
+
+    replicas = {bind: get_pool_status(db.get_engine(app, bind=bind))
+                for bind in get_replica_binds(app)}
+
+    return jsonify(dict(get_pool_status(db.engine), replicas=replicas,
+                        **pool_stats))
+
+
+##############################################################################
+# Command-line maintenance tasks (run like `flask rebuild-timelines`)
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Rebuild every user's home timeline from follows and messages."""
+
+    rebuild_timelines()
+    db.session.commit()
+
+
+@app.cli.command('recount')
+def recount_command():
+    """Recompute every user's message, follow and like counters."""
+
+    recount()
+    db.session.commit()
+
+
+@app.cli.command('upgrade-schema')
+def upgrade_schema_command():
+    """Bring a database created by an older models.py up to date.
+
+    Adds missing columns, such as the User counters, and keys likes on
+    (user_id, message_id), deleting duplicates. Then recounts the counters
+    if anything changed. Run `flask create-indexes` afterwards.
+    """
+
+    added = add_missing_columns()
+
+    for name in added:
+        click.echo(f"Added {name}")
+
+    rekeyed = rekey_likes()
+
+    if rekeyed:
+        click.echo("Keyed likes on (user_id, message_id)")
+
+    if added or rekeyed:
+        recount()
+        db.session.commit()
+        click.echo("Recounted")
+
+
+@app.cli.command('create-indexes')
+def create_indexes_command():
+    """Add indexes declared in models.py that the database is missing.
+
+    On PostgreSQL, also enables pg_trgm and adds the user search indexes.
+    """
+
+    for name in create_missing_indexes():
+        click.echo(f"Created {name}")
+
+    for name in create_search_indexes():
+        click.echo(f"Ensured {name}")
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a hot route's query plan seq scans a large table.
+
+    Meant to be run against a database seeded with production-like volumes.
+    """
+
+    try:
+        regressions = find_seq_scans()
+    except NoSampleData as error:
+        raise click.ClickException(str(error))
+
+    for description, tables in regressions.items():
+        click.echo(f"{description}: seq scan on {', '.join(tables)}", err=True)
+
+    if regressions:
+        raise SystemExit(1)
+
+    click.echo("All hot queries use indexes.")
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Caching headers: long-lived fingerprinted static files, revalidated
+# ETags on the pages that set them, and no caching for everything else
+# (see httpcache.py)
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Add caching headers to every response."""
+
+    return add_cache_headers(response)
@@ -0,0 +1,12 @@
+"""Support functions for the benchmarks."""
+
+
+def percentile(timings, pct):
+    """Return the `pct`th percentile of `timings` (NaN if there are none)."""
+
+    if not timings:
+        return float('nan')
+
+    timings = sorted(timings)
+
+    return timings[min(len(timings) - 1, len(timings) * pct // 100)]
@@ -0,0 +1,114 @@
+"""Benchmark concurrent like toggles ("like storms").
+
+Several threads hammer /users/add-like/<id> for the same message at once,
+both as the same user (double-clicks) and as different users. Reports
+toggles per second, and how many duplicate (user, message) like rows
+were left behind.
+
+This drops and recreates every table in the database it's pointed at, so
+give it its own database. Run it from the project root like:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/like_storm.py
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app, CURR_USER_KEY
+from models import db, User, Message, Likes
+
+
+def seed(num_users):
+    """Create `num_users` users and one message for them all to like."""
+
+    db.drop_all()
+    db.create_all()
+
+    users = [User(username=f"storm{i}",
+                  email=f"storm{i}@test.com",
+                  password="not-a-real-hash")
+             for i in range(num_users + 1)]
+
+    db.session.add_all(users)
+    db.session.flush()
+
+    author, *likers = users
+    msg = Message(text="Like me!", user_id=author.id)
+
+    db.session.add(msg)
+    db.session.commit()
+
+    return [user.id for user in likers], msg.id
+
+
+def storm(user_id, message_id, toggles, start):
+    """Toggle a like `toggles` times as `user_id`, once `start` is set."""
+
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    start.wait()
+
+    for _ in range(toggles):
+        client.post(f"/users/add-like/{message_id}")
+
+
+def count_duplicate_likes():
+    """Return how many extra like rows exist for already-liked pairs."""
+
+    counts = (db.session
+              .query(db.func.count())
+              .select_from(Likes)
+              .group_by(Likes.user_id, Likes.message_id)
+              .all())
+
+    return sum(count - 1 for (count,) in counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--users', type=int, default=2,
+                        help="distinct users; threads share users round-robin")
+    parser.add_argument('--toggles', type=int, default=200,
+                        help="toggles per thread")
+    args = parser.parse_args()
+
+    user_ids, message_id = seed(args.users)
+    start = threading.Event()
+
+    threads = [threading.Thread(target=storm,
+                                args=(user_ids[i % len(user_ids)],
+                                      message_id,
+                                      args.toggles,
+                                      start))
+               for i in range(args.threads)]
+
+    for thread in threads:
+        thread.start()
+
+    began = time.perf_counter()
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - began
+    total = args.threads * args.toggles
+
+    print(f"{total} toggles in {elapsed:.2f}s: {total / elapsed:.0f} toggles/s")
+    print(f"duplicate like rows: {count_duplicate_likes()}")
+
+
+if __name__ == '__main__':
+    main()
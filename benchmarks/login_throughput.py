@@ -0,0 +1,108 @@
+"""Benchmark login throughput against the number of hashing threads.
+
+Several threads log in over and over through /login. This is repeated with
+1, 2, 4, ... password hashing threads (up to the number of CPUs), reporting
+logins per second for each. bcrypt releases the GIL, so throughput should
+grow with the number of hashing threads until the cores run out.
+
+This drops and recreates every table in the database it's pointed at, so
+give it its own database. Run it from the project root like:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/login_throughput.py
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app
+from models import db, User
+from passwords import password_hasher
+
+
+def seed(num_users):
+    """Create `num_users` users, all with the password "password"."""
+
+    db.drop_all()
+    db.create_all()
+
+    for i in range(num_users):
+        User.signup(username=f"login{i}",
+                    email=f"login{i}@test.com",
+                    password="password",
+                    image_url=None)
+
+    db.session.commit()
+
+
+def log_in(username, logins, start):
+    """Log in as `username` `logins` times, once `start` is set."""
+
+    client = app.test_client()
+    start.wait()
+
+    for _ in range(logins):
+        resp = client.post('/login', data={'username': username,
+                                           'password': 'password'})
+        assert resp.status_code == 302, resp.status_code
+
+
+def run(num_threads, logins):
+    """Return logins per second with `num_threads` clients logging in."""
+
+    start = threading.Event()
+
+    threads = [threading.Thread(target=log_in,
+                                args=(f"login{i}", logins, start))
+               for i in range(num_threads)]
+
+    for thread in threads:
+        thread.start()
+
+    began = time.perf_counter()
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    return num_threads * logins / (time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--logins', type=int, default=10,
+                        help="logins per thread")
+    parser.add_argument('--rounds', type=int, default=12,
+                        help="bcrypt cost")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    password_hasher.rounds = args.rounds
+    password_hasher.queue_timeout = None
+
+    seed(args.threads)
+
+    workers = 1
+
+    while workers <= (os.cpu_count() or 1):
+        password_hasher.shutdown()
+        password_hasher.workers = workers
+
+        rate = run(args.threads, args.logins)
+        print(f"{workers} hashing threads: {rate:.1f} logins/s")
+
+        workers *= 2
+
+    password_hasher.shutdown()
+
+
+if __name__ == '__main__':
+    main()
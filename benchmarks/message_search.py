@@ -0,0 +1,97 @@
+"""Benchmark message search (/messages/search?q=...) latency.
+
+Fills the messages table with generated messages, then times
+`search_messages` for a mix of word and prefix queries, on the first page
+and on a following page, and prints p50/p95/p99 latency.
+
+This drops and recreates every table in the database it's pointed at, so
+give it its own database. Run it from the project root like:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/message_search.py --messages 10000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app
+from helpers import percentile
+from models import db
+from search import search_messages, create_search_indexes
+
+WORDS = ['heron', 'warbler', 'sparrow', 'coffee', 'rain', 'morning', 'city',
+         'river', 'lunch', 'train', 'music', 'garden', 'finch', 'storm']
+
+QUERIES = ['heron', 'war', 'spar rain', 'coffee morning', 'fin', 'gard riv',
+           'xylophone']
+
+
+def seed(num_users, num_messages):
+    """Fill the tables with generated users and messages, in SQL."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute("""
+        INSERT INTO users (email, username, password)
+        SELECT 'user' || i || '@test.com', 'user' || i, 'not-a-real-hash'
+        FROM generate_series(1, :num_users) AS i
+    """, dict(num_users=num_users))
+
+    # each message is four random words plus a unique token
+    db.session.execute("""
+        INSERT INTO messages (text, timestamp, user_id)
+        SELECT (:words)[1 + (random() * (array_length(:words, 1) - 1))::int]
+                   || ' ' || (:words)[1 + (random() * (array_length(:words, 1) - 1))::int]
+                   || ' ' || (:words)[1 + (random() * (array_length(:words, 1) - 1))::int]
+                   || ' ' || (:words)[1 + (random() * (array_length(:words, 1) - 1))::int]
+                   || ' ' || md5(i::text),
+               now() - (i || ' seconds')::interval,
+               1 + i % :num_users
+        FROM generate_series(1, :num_messages) AS i
+    """, dict(words=WORDS, num_users=num_users, num_messages=num_messages))
+
+    db.session.commit()
+    create_search_indexes()
+    db.session.execute("ANALYZE messages")
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=10000000)
+    parser.add_argument('--searches', type=int, default=200)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.users, args.messages)
+
+        timings = []
+
+        for _ in range(args.searches):
+            query = random.choice(QUERIES)
+
+            started = time.perf_counter()
+            messages, cursor = search_messages(query)
+
+            if cursor:
+                search_messages(query, before=cursor)
+
+            timings.append((time.perf_counter() - started) * 1000)
+
+    print(f"{args.messages} messages, two pages per search")
+    print(f"p50 {percentile(timings, 50):.1f}ms  "
+          f"p95 {percentile(timings, 95):.1f}ms  "
+          f"p99 {percentile(timings, 99):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
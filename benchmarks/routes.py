@@ -0,0 +1,337 @@
+"""Benchmark the main routes with concurrent clients.
+
+Seeds a database of generated users, messages and follows through the
+models, then for each route runs several client threads, each logged in as
+a random user, making requests as fast as they can. Records p50/p95/p99
+latency, throughput, error responses and SQL statements per request (from
+the app's own instrumentation), and writes them as JSON, so runs can be
+diffed between commits:
+
+    python benchmarks/routes.py --output before.json
+    git checkout my-branch
+    python benchmarks/routes.py --skip-seed --output after.json --compare before.json
+
+Everything random is drawn from `--seed`, so reruns make the same requests.
+The routes that write (new_message and like) run after the others, and what
+they added is deleted again after each, so every route of every run, with
+or without `--skip-seed`, sees the data as it was seeded.
+
+This drops and recreates every table in the database it's pointed at, so
+give it its own database. Run it from the project root like:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/routes.py --users 10000
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app, CURR_USER_KEY
+from helpers import percentile
+from models import db, User, Message, Follows, Likes
+from counters import recount
+from instrumentation import get_route_metrics
+from passwords import password_hasher
+from ratelimit import login_limiter
+from timeline import rebuild_timelines
+
+PASSWORD = "password"
+
+# rows per bulk insert while seeding
+SEED_BATCH_SIZE = 10000
+
+# A route to benchmark: the view's endpoint name (to find its SQL totals),
+# the HTTP method, functions of (rng, ids) returning the path and form data
+# of a request, and whether it changes the data (see undo_writes).
+Route = namedtuple('Route', 'endpoint method get_path get_data writes')
+
+ROUTES = {
+    'home': Route('homepage', 'GET',
+                  lambda rng, ids: '/', None, False),
+    'users': Route('list_users', 'GET',
+                   lambda rng, ids: '/users', None, False),
+    'user': Route('users_show', 'GET',
+                  lambda rng, ids: f"/users/{rng.choice(ids.users)}", None,
+                  False),
+    'followers': Route('users_followers', 'GET',
+                       lambda rng, ids: f"/users/{rng.choice(ids.users)}/followers",
+                       None, False),
+    'login': Route('login', 'POST',
+                   lambda rng, ids: '/login',
+                   lambda rng, ids: dict(username=f"bench{rng.choice(ids.users)}",
+                                         password=PASSWORD),
+                   False),
+    'new_message': Route('messages_add', 'POST',
+                         lambda rng, ids: '/messages/new',
+                         lambda rng, ids: dict(text=f"Benchmark {rng.random()}"),
+                         True),
+    'like': Route('like_message', 'POST',
+                  lambda rng, ids: f"/users/add-like/{rng.choice(ids.messages)}",
+                  None, True),
+}
+
+Ids = namedtuple('Ids', 'users messages')
+
+
+def seed(num_users, messages_per_user, follows_per_user, rng):
+    """Create the users, messages and follows to benchmark against.
+
+    Every user's password is PASSWORD, hashed once and shared.
+    """
+
+    db.drop_all()
+    db.create_all()
+
+    hashed = password_hasher.hash(PASSWORD)
+    now = datetime.utcnow()
+
+    def insert(model, rows):
+        batch = []
+
+        for row in rows:
+            batch.append(row)
+
+            if len(batch) == SEED_BATCH_SIZE:
+                db.session.bulk_insert_mappings(model, batch)
+                batch = []
+
+        db.session.bulk_insert_mappings(model, batch)
+
+    insert(User, (dict(username=f"bench{i}",
+                       email=f"bench{i}@test.com",
+                       password=hashed,
+                       bio=f"Benchmark user {i}")
+                  for i in range(1, num_users + 1)))
+
+    user_ids = [user_id for (user_id,) in db.session.query(User.id)]
+
+    insert(Message, (dict(text=f"Message {i} from user {user_id}",
+                          timestamp=now - timedelta(minutes=rng.randint(0, 525600)),
+                          user_id=user_id)
+                     for user_id in user_ids
+                     for i in range(messages_per_user)))
+
+    follows = min(follows_per_user, num_users - 1)
+
+    insert(Follows, (dict(user_being_followed_id=followed_id,
+                          user_following_id=user_id)
+                     for user_id in user_ids
+                     for followed_id in rng.sample(user_ids, follows + 1)
+                     if followed_id != user_id))
+
+    recount()
+    rebuild_timelines()
+    db.session.commit()
+    db.session.execute("ANALYZE")
+    db.session.commit()
+
+
+def get_ids():
+    """Return the ids of the users and messages requests can pick from."""
+
+    users = [user_id for (user_id,) in db.session.query(User.id).order_by(User.id)]
+    messages = [msg_id for (msg_id,) in db.session.query(Message.id).order_by(Message.id)]
+
+    return Ids(users, messages)
+
+
+def undo_writes(ids):
+    """Delete what the writing routes added since the data was seeded.
+
+    Seeding adds no likes, so they all go, and so do messages newer than
+    the seeded ones (their timeline entries and likes go with them).
+    """
+
+    Likes.query.delete()
+    (Message.query
+     .filter(Message.id > max(ids.messages, default=0))
+     .delete(synchronize_session=False))
+    recount()
+    db.session.commit()
+
+
+def run_client(route, ids, rng, num_requests, start, timings, errors):
+    """Make `num_requests` requests to `route` once `start` is set."""
+
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = rng.choice(ids.users)
+
+    start.wait()
+
+    for _ in range(num_requests):
+        path = route.get_path(rng, ids)
+        data = route.get_data(rng, ids) if route.get_data else None
+
+        started = time.perf_counter()
+        resp = client.open(path, method=route.method, data=data)
+        timings.append((time.perf_counter() - started) * 1000)
+
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+
+
+def run_route(name, route, ids, num_clients, num_requests, seed_value):
+    """Benchmark one route; return its results."""
+
+    before = get_route_metrics().get(route.endpoint, {})
+    timings = []
+    errors = []
+    start = threading.Event()
+
+    threads = [threading.Thread(target=run_client,
+                                args=(route, ids,
+                                      random.Random(f"{seed_value}-{name}-{i}"),
+                                      num_requests, start, timings, errors))
+               for i in range(num_clients)]
+
+    for thread in threads:
+        thread.start()
+
+    began = time.perf_counter()
+    start.set()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - began
+    after = get_route_metrics().get(route.endpoint, {})
+
+    requests = after.get('requests', 0) - before.get('requests', 0)
+    statements = after.get('statements', 0) - before.get('statements', 0)
+
+    return {
+        'requests': len(timings),
+        'errors': len(errors),
+        'throughput_rps': round(len(timings) / elapsed, 1),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'queries_per_request': round(statements / requests, 2) if requests else None,
+    }
+
+
+def get_commit():
+    """Return the checked-out commit, or None outside a git checkout."""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    """Print a table of the results, with changes from `baseline`."""
+
+    columns = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request')
+    print(f"{'route':<12}" + ''.join(f"{column:>22}" for column in columns))
+
+    for name, results in report['routes'].items():
+        old = (baseline or {}).get('routes', {}).get(name, {})
+        cells = []
+
+        for column in columns:
+            value = results[column]
+            cell = f"{value}"
+
+            if old.get(column) and value is not None:
+                cell += f" ({(value - old[column]) / old[column]:+.0%})"
+
+            cells.append(f"{cell:>22}")
+
+        print(f"{name:<12}" + ''.join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages-per-user', type=int, default=20)
+    parser.add_argument('--follows-per-user', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=4,
+                        help="concurrent client threads per route")
+    parser.add_argument('--requests', type=int, default=100,
+                        help="requests per client per route")
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help="comma-separated routes to run, from: " + ', '.join(ROUTES))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skip-seed', action='store_true',
+                        help="reuse the database from an earlier run")
+    parser.add_argument('--output', help="file to write the JSON report to")
+    parser.add_argument('--compare', help="an earlier JSON report to compare with")
+    args = parser.parse_args()
+
+    # writing routes last, so the others see the seeded data
+    names = sorted(args.routes.split(','),
+                   key=lambda name: name in ROUTES and ROUTES[name].writes)
+    unknown = [name for name in names if name not in ROUTES]
+
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    # measure logging in itself, not the limiter or the hashing queue
+    login_limiter.limits = {kind: (10 ** 9, 1) for kind in login_limiter.limits}
+    password_hasher.queue_timeout = None
+
+    with app.app_context():
+        if not args.skip_seed:
+            seed(args.users, args.messages_per_user, args.follows_per_user,
+                 random.Random(args.seed))
+
+        ids = get_ids()
+
+        # in case an earlier run was interrupted
+        undo_writes(ids)
+        db.session.remove()
+
+    settings = {key: value for key, value in vars(args).items()
+                if key not in ('output', 'compare', 'skip_seed')}
+
+    report = {
+        'commit': get_commit(),
+        'settings': settings,
+        'routes': {},
+    }
+
+    for name in names:
+        route = ROUTES[name]
+        report['routes'][name] = run_route(name, route, ids, args.clients,
+                                           args.requests, args.seed)
+
+        if route.writes:
+            with app.app_context():
+                undo_writes(ids)
+                db.session.remove()
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+            file.write('\n')
+
+
+if __name__ == '__main__':
+    main()
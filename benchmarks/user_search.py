@@ -0,0 +1,88 @@
+"""Benchmark user search (/users?q=...) latency.
+
+Fills the users table with generated users, then times `search_users` for
+a mix of username, bio and location queries and prints p50/p95/p99
+latency. Uses pg_trgm if the server has it, otherwise a plain ILIKE
+scan.
+
+This drops and recreates every table in the database it's pointed at, so
+give it its own database. Run it from the project root like:
+
+    createdb warbler-bench
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/user_search.py --users 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app
+from helpers import percentile
+from models import db
+from search import search_users, create_search_indexes, has_trigram_support
+
+QUERIES = ['user_1', 'a3f', 'bird', 'Oakland', '99', 'zzzzzz', 'e4d9', 'port']
+
+
+def seed(num_users):
+    """Fill the users table with `num_users` generated users, in SQL."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute("""
+        INSERT INTO users (email, username, password, bio, location)
+        SELECT 'user' || i || '@test.com',
+               'user_' || i || '_' || substr(md5(i::text), 1, 6),
+               'not-a-real-hash',
+               (ARRAY['bird watcher', 'coffee drinker', 'night owl'])[i % 3 + 1]
+                   || ' ' || substr(md5((i * 7)::text), 1, 8),
+               (ARRAY['Oakland', 'Portland', 'Austin', 'Boston'])[i % 4 + 1]
+        FROM generate_series(1, :num_users) AS i
+    """, dict(num_users=num_users))
+
+    db.session.commit()
+    create_search_indexes()
+    db.session.execute("ANALYZE users")
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--searches', type=int, default=200)
+    args = parser.parse_args()
+
+    with app.app_context():
+        seed(args.users)
+
+        backend = 'pg_trgm' if has_trigram_support() else 'ILIKE scan'
+
+        # the first search warms the caches
+        started = time.perf_counter()
+        search_users(QUERIES[0])
+        warmup = time.perf_counter() - started
+
+        timings = []
+
+        for _ in range(args.searches):
+            query = random.choice(QUERIES)
+
+            started = time.perf_counter()
+            search_users(query, page=random.randint(1, 3))
+            timings.append((time.perf_counter() - started) * 1000)
+
+    print(f"{args.users} users, {backend}, first search {warmup:.2f}s")
+    print(f"p50 {percentile(timings, 50):.1f}ms  "
+          f"p95 {percentile(timings, 95):.1f}ms  "
+          f"p99 {percentile(timings, 99):.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
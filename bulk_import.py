@@ -0,0 +1,280 @@
+"""Bulk loading of the generator's CSVs (see seed.py).
+
+The CSVs are streamed in chunks of `chunk_size` rows, so memory use doesn't
+grow with the file. On PostgreSQL each chunk is sent with COPY, and the
+secondary indexes and foreign keys of the big tables are dropped first and
+recreated once everything is loaded, which is much faster than maintaining
+them row by row. Other databases get batched INSERTs, with each field
+converted to its column's type first.
+
+Each chunk is committed along with a count of the rows loaded from its file
+(in the import_progress table), so an interrupted import can pick up where
+it stopped with `resume=True`. The counts are cleared once the import
+finishes, so there's nothing left to resume. Rows without an id in the CSV
+are given their line number as one, so ids don't depend on how many
+attempts it took.
+"""
+
+import csv
+import io
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import AddConstraint
+
+from models import db, User, Message, Follows
+from indexes import create_missing_indexes
+from search import create_search_indexes
+from counters import recount
+from timeline import rebuild_timelines
+
+CHUNK_SIZE = 10000
+
+# (table, file name), in the order they must be loaded
+IMPORT_FILES = (
+    (User.__table__, 'users.csv'),
+    (Message.__table__, 'messages.csv'),
+    (Follows.__table__, 'follows.csv'),
+)
+
+# tables whose secondary indexes and foreign keys wait until after the load
+DEFERRED_TABLES = (Message.__table__, Follows.__table__)
+
+# seconds between progress reports within a file
+REPORT_INTERVAL = 5
+
+import_progress = db.Table(
+    'import_progress',
+    db.Column('filename', db.Text, primary_key=True),
+    db.Column('rows_loaded', db.Integer, nullable=False),
+)
+
+
+def is_postgresql():
+    """Is the database PostgreSQL (so COPY is available)?"""
+
+    return db.engine.dialect.name == 'postgresql'
+
+
+def get_rows_loaded():
+    """Return {filename: rows loaded} from an earlier import."""
+
+    if not db.engine.has_table(import_progress.name):
+        return {}
+
+    with db.engine.connect() as conn:
+        rows = conn.execute(db.select([import_progress.c.filename,
+                                       import_progress.c.rows_loaded]))
+        return {filename: rows_loaded for filename, rows_loaded in rows}
+
+
+def read_chunks(reader, table, chunk_size, first_line):
+    """Yield lists of up to `chunk_size` rows from a CSV reader.
+
+    Rows are numbered from `first_line`; if `table` has an id the CSV
+    doesn't, the number is prepended as the row's id.
+    """
+
+    add_id = 'id' in table.c
+    line = first_line
+
+    while True:
+        rows = list(islice(reader, chunk_size))
+
+        if not rows:
+            return
+
+        if add_id:
+            rows = [[line + i] + row for i, row in enumerate(rows)]
+
+        line += len(rows)
+        yield rows
+
+
+def copy_rows(conn, table, columns, rows):
+    """Send `rows` to `table` with PostgreSQL's COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) "
+                       "FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def get_converter(column):
+    """Return a function turning a CSV field into a value for `column`."""
+
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return str
+
+    if python_type is datetime:
+        return datetime.fromisoformat
+
+    return python_type
+
+
+def insert_rows(conn, table, columns, rows):
+    """Insert `rows` into `table` with one batched INSERT.
+
+    Fields are converted to their columns' types, which COPY does on the
+    server, and empty fields become NULL, as they do with COPY.
+    """
+
+    converters = [get_converter(table.c[column]) for column in columns]
+
+    conn.execute(table.insert(),
+                 [{column: convert(value) if value != '' else None
+                   for column, convert, value in zip(columns, converters, row)}
+                  for row in rows])
+
+
+def save_progress(conn, filename, rows_loaded):
+    """Record that the first `rows_loaded` rows of `filename` are loaded."""
+
+    conn.execute(import_progress.delete()
+                 .where(import_progress.c.filename == filename))
+    conn.execute(import_progress.insert(),
+                 filename=filename, rows_loaded=rows_loaded)
+
+
+def load_csv(table, path, chunk_size, skip=0, report=print):
+    """Load the CSV at `path` into `table`, skipping its first `skip` rows.
+
+    Returns the number of rows loaded by this call.
+    """
+
+    filename = os.path.basename(path)
+    write_rows = copy_rows if is_postgresql() else insert_rows
+
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        columns = next(reader)
+
+        unknown = [column for column in columns if column not in table.c]
+
+        if unknown:
+            raise ValueError(f"{filename} has unknown columns: {unknown}")
+
+        if 'id' in table.c and 'id' not in columns:
+            columns = ['id'] + columns
+
+        rows_loaded = skip
+        started = last_report = time.monotonic()
+
+        for rows in read_chunks(islice(reader, skip, None), table,
+                                chunk_size, skip + 1):
+            with db.engine.begin() as conn:
+                write_rows(conn, table, columns, rows)
+                rows_loaded += len(rows)
+                save_progress(conn, filename, rows_loaded)
+
+            now = time.monotonic()
+
+            if now - last_report >= REPORT_INTERVAL:
+                report_rate(report, filename, rows_loaded - skip, now - started)
+                last_report = now
+
+    report_rate(report, filename, rows_loaded - skip,
+                time.monotonic() - started)
+
+    return rows_loaded - skip
+
+
+def report_rate(report, filename, rows, seconds):
+    """Report how many rows of `filename` were loaded, and how fast."""
+
+    report(f"{filename}: {rows} rows in {seconds:.1f}s "
+           f"({rows / max(seconds, 1e-6):,.0f} rows/s)")
+
+
+def drop_deferred_constraints():
+    """Drop the secondary indexes and foreign keys of DEFERRED_TABLES."""
+
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in DEFERRED_TABLES:
+            for index in table.indexes:
+                conn.execute(f'DROP INDEX IF EXISTS "{index.name}"')
+
+            for foreign_key in inspector.get_foreign_keys(table.name):
+                conn.execute(f'ALTER TABLE {table.name} '
+                             f'DROP CONSTRAINT "{foreign_key["name"]}"')
+
+
+def restore_deferred_constraints():
+    """Recreate whatever `drop_deferred_constraints` dropped."""
+
+    create_missing_indexes()
+
+    inspector = inspect(db.engine)
+
+    with db.engine.begin() as conn:
+        for table in DEFERRED_TABLES:
+            existing = {tuple(foreign_key['constrained_columns'])
+                        for foreign_key in inspector.get_foreign_keys(table.name)}
+
+            for foreign_key in table.foreign_key_constraints:
+                if tuple(foreign_key.column_keys) not in existing:
+                    conn.execute(AddConstraint(foreign_key))
+
+
+def reset_id_sequences():
+    """Move id sequences past the ids loaded from the CSVs."""
+
+    with db.engine.begin() as conn:
+        for table, _ in IMPORT_FILES:
+            if 'id' in table.c:
+                max_id = conn.execute(db.select([func.max(table.c.id)])).scalar()
+
+                if max_id:
+                    conn.execute(db.text("SELECT setval(pg_get_serial_sequence("
+                                         ":table, 'id'), :max_id)"),
+                                 table=table.name, max_id=max_id)
+
+
+def import_csvs(directory, chunk_size=CHUNK_SIZE, resume=False, report=print):
+    """Replace the database's contents with the CSVs in `directory`.
+
+    With `resume`, continue an interrupted import instead of starting over.
+    Once the rows are loaded, indexes and foreign keys are restored and the
+    counters and timelines rebuilt.
+    """
+
+    rows_loaded = get_rows_loaded() if resume else {}
+
+    if resume and not rows_loaded:
+        raise ValueError("There's no interrupted import to resume")
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+
+        if is_postgresql():
+            drop_deferred_constraints()
+
+    for table, filename in IMPORT_FILES:
+        load_csv(table, os.path.join(directory, filename), chunk_size,
+                 skip=rows_loaded.get(filename, 0), report=report)
+
+    if is_postgresql():
+        reset_id_sequences()
+        report("Restoring indexes and foreign keys")
+        restore_deferred_constraints()
+        create_search_indexes()
+        db.session.execute("ANALYZE")
+
+    report("Rebuilding counters and timelines")
+    recount()
+    rebuild_timelines()
+
+    # finished, so there's nothing to resume
+    db.session.execute(import_progress.delete())
+    db.session.commit()
@@ -0,0 +1,81 @@
+"""Denormalized per-user counters for Warbler.
+
+`User.messages_count`, `following_count`, `followers_count` and
+`likes_count` are kept up to date by the routes that change the underlying
+rows, so templates can show counts without loading the related objects.
+
+Like timeline.py, nothing here commits; updates happen in the caller's
+transaction. If the counts ever drift (e.g. after a bulk load), run
+`flask recount` to recompute them.
+"""
+
+from models import db, User, Message, Follows, Likes
+from user_cache import invalidate_user
+
+
+def adjust_counts(user_ids, **deltas):
+    """Add `deltas` to the counters of the given user(s).
+
+    For example, `adjust_counts(user.id, messages_count=1)`. `user_ids` may
+    be a single id, a list of ids or a query selecting ids. Cached copies of
+    listed users' counts (see user_cache.py) are dropped; users selected by
+    a query keep theirs until the cache expires.
+    """
+
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+
+    if isinstance(user_ids, list):
+        invalidate_user(*user_ids)
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+
+    (User
+     .query
+     .filter(User.id.in_(user_ids))
+     .update(values, synchronize_session=False))
+
+
+def recount(user_ids=None):
+    """Recompute counters from scratch, for `user_ids` or for every user."""
+
+    def count_where(*criteria):
+        return db.select([db.func.count()]).where(db.and_(*criteria)).as_scalar()
+
+    values = {
+        User.messages_count: count_where(Message.user_id == User.id),
+        User.following_count: count_where(Follows.user_following_id == User.id),
+        User.followers_count: count_where(Follows.user_being_followed_id == User.id),
+        User.likes_count: count_where(Likes.user_id == User.id),
+    }
+
+    query = User.query
+
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+
+    query.update(values, synchronize_session=False)
+
+
+def get_related_user_ids(user):
+    """Return ids of users whose counts change if `user` is deleted.
+
+    That's everyone following or followed by `user`, and everyone who has
+    liked one of `user`'s messages.
+    """
+
+    followers = (db.session
+                 .query(Follows.user_following_id)
+                 .filter(Follows.user_being_followed_id == user.id))
+
+    following = (db.session
+                 .query(Follows.user_being_followed_id)
+                 .filter(Follows.user_following_id == user.id))
+
+    likers = (db.session
+              .query(Likes.user_id)
+              .join(Message, Message.id == Likes.message_id)
+              .filter(Message.user_id == user.id))
+
+    return {user_id for (user_id,) in followers.union(following, likers)}
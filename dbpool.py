@@ -0,0 +1,156 @@
+"""Database connection pool settings, statement timeouts and pool stats.
+
+The pool is sized and tuned from app config (set from DB_* environment
+variables in app.py) by `PooledSQLAlchemy`, which `models.db` is an
+instance of:
+
+    DB_POOL_SIZE        connections kept open
+    DB_MAX_OVERFLOW     extra connections opened under load, then closed
+    DB_POOL_TIMEOUT     seconds to wait for a connection before giving up
+    DB_POOL_RECYCLE     seconds after which a connection is replaced
+    DB_POOL_PRE_PING    test connections on checkout, replacing dead ones
+    DB_EXTERNAL_POOLER  connections go through a pooler such as PgBouncer
+                        (in transaction mode), which does the pooling, so
+                        each checkout opens a fresh connection to it
+
+Statements in a request are cancelled if they run longer than the route's
+timeout (STATEMENT_TIMEOUTS, by endpoint, or STATEMENT_TIMEOUT_MS). The
+timeout is set with SET LOCAL at the start of each transaction, so it
+never outlives the transaction, which keeps it safe behind a transaction
+pooler where the next transaction may be another client's.
+
+`get_pool_status` reports a pool's occupancy; `stats` counts its use.
+"""
+
+from collections import Counter
+
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool, Pool
+
+# Defaults for the pool settings above
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+
+# Default statement timeout in milliseconds; 0 means none
+STATEMENT_TIMEOUT_MS = 0
+
+# Counters for this process: connections opened, checked out and in, and
+# found dead (by pre-ping or when a statement failed) and thrown away. The
+# app's error handlers add requests refused because no connection came free
+# (exhausted) or a statement ran too long (statement_timeouts).
+stats = Counter()
+
+
+def get_engine_options(config):
+    """Return create_engine options for the pool settings in `config`."""
+
+    if config.get('DB_EXTERNAL_POOLER'):
+        return {'poolclass': NullPool}
+
+    return {
+        'pool_size': config.get('DB_POOL_SIZE', DB_POOL_SIZE),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', DB_POOL_TIMEOUT),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', DB_POOL_RECYCLE),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with its engines' pools configured from app config."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super().apply_driver_hacks(app, sa_url, options)
+
+        # SQLite's pools don't take size settings
+        if sa_url.drivername.startswith('postgres'):
+            options.update(get_engine_options(app.config))
+
+        return rv
+
+
+def get_statement_timeout():
+    """Return the current route's statement timeout in milliseconds."""
+
+    config = current_app.config
+    timeouts = config.get('STATEMENT_TIMEOUTS', {})
+
+    return timeouts.get(request.endpoint,
+                        config.get('STATEMENT_TIMEOUT_MS', STATEMENT_TIMEOUT_MS))
+
+
+def set_statement_timeout(session, transaction, connection):
+    """Apply the route's statement timeout to a transaction as it begins.
+
+    Run on the DBAPI cursor, so it isn't logged as one of the route's own
+    statements (see instrumentation.py).
+    """
+
+    if not has_request_context() or connection.dialect.name != 'postgresql':
+        return
+
+    timeout = get_statement_timeout()
+
+    if timeout:
+        cursor = connection.connection.cursor()
+        cursor.execute("SET LOCAL statement_timeout = %s", (int(timeout),))
+        cursor.close()
+
+
+# pool events, counted into `stats`
+
+def count_connect(dbapi_connection, connection_record):
+    stats['connects'] += 1
+
+
+def count_checkout(dbapi_connection, connection_record, connection_proxy):
+    stats['checkouts'] += 1
+
+
+def count_checkin(dbapi_connection, connection_record):
+    stats['checkins'] += 1
+
+
+def count_invalidate(dbapi_connection, connection_record, exception):
+    stats['invalidated'] += 1
+
+
+def is_statement_timeout(error):
+    """Was `error` (a DBAPIError) raised by a cancelled statement?"""
+
+    return getattr(error.orig, 'pgcode', None) == '57014'
+
+
+def get_pool_status(engine):
+    """Return the occupancy of `engine`'s pool."""
+
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+
+    if hasattr(pool, 'size'):
+        status.update(size=pool.size(),
+                      checked_in=pool.checkedin(),
+                      checked_out=pool.checkedout(),
+                      overflow=pool.overflow())
+
+    return status
+
+
+def init_pool():
+    """Apply statement timeouts to requests' sessions and count pool events.
+
+    Listens on every pool and session, so it also covers engines created
+    later.
+    """
+
+    if not event.contains(Session, 'after_begin', set_statement_timeout):
+        event.listen(Session, 'after_begin', set_statement_timeout)
+        event.listen(Pool, 'connect', count_connect)
+        event.listen(Pool, 'checkout', count_checkout)
+        event.listen(Pool, 'checkin', count_checkin)
+        event.listen(Pool, 'invalidate', count_invalidate)
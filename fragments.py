@@ -0,0 +1,85 @@
+"""Cached rendering of message cards.
+
+Feeds render the same messages over and over: the homepage, profiles, likes
+and search all show a card per message (templates/messages/card.html).
+`message_card` renders each card once and keeps the HTML in an in-process
+LRU cache, so a hot timeline mostly joins cached strings.
+
+Only the parts that are the same for every viewer are cached; the like
+button is rendered around the card by each feed template. A card is keyed
+by message id and stamped with a version made from the author's username
+and image, so an edited profile never shows a stale card, even in processes
+that didn't see the edit. `invalidate_message` and `invalidate_author` also
+drop entries eagerly, to free the space.
+"""
+
+import threading
+from collections import Counter, OrderedDict
+
+from flask import current_app, Markup
+
+# Default most cards kept at once; override with the FRAGMENT_CACHE_SIZE app
+# config setting.
+FRAGMENT_CACHE_SIZE = 10000
+
+# Counters for this process: card cache hits and misses.
+stats = Counter()
+
+# {message_id: (author_id, version, html)}, least recently used first
+card_cache = OrderedDict()
+card_cache_lock = threading.Lock()
+
+
+def get_card_version(msg):
+    """Return what a cached card of `msg` must match to be reused."""
+
+    return (msg.user.username, msg.user.image_url)
+
+
+def message_card(msg):
+    """Return the rendered card for `msg`, from the cache if possible."""
+
+    version = get_card_version(msg)
+
+    with card_cache_lock:
+        author_id, cached_version, html = card_cache.get(msg.id, (None, None, None))
+
+        if cached_version == version:
+            card_cache.move_to_end(msg.id)
+            stats['hits'] += 1
+            return html
+
+    stats['misses'] += 1
+
+    template = current_app.jinja_env.get_template('messages/card.html')
+    html = Markup(template.render(msg=msg))
+
+    max_size = current_app.config.get('FRAGMENT_CACHE_SIZE', FRAGMENT_CACHE_SIZE)
+
+    with card_cache_lock:
+        card_cache[msg.id] = (msg.user_id, version, html)
+        card_cache.move_to_end(msg.id)
+
+        while len(card_cache) > max_size:
+            card_cache.popitem(last=False)
+
+    return html
+
+
+def invalidate_message(message_id):
+    """Drop the cached card of a message, e.g. when it's deleted."""
+
+    with card_cache_lock:
+        card_cache.pop(message_id, None)
+
+
+def invalidate_author(user_id):
+    """Drop the cached cards of every message by `user_id`."""
+
+    with card_cache_lock:
+        stale = [message_id
+                 for message_id, (author_id, _, _) in card_cache.items()
+                 if author_id == user_id]
+
+        for message_id in stale:
+            del card_cache[message_id]
@@ -2,15 +2,36 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load tests:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --out /tmp/warbler-csvs
+
+See `--help` for the other options. Nothing is fetched over the network.
+
+Rows are generated in chunks of CHUNK_ROWS by a pool of processes, each
+writing its own part file, and the parts are then joined in order. Every
+chunk has its own random seed, so with `--seed` the output is the same
+however many processes are used. Message timestamps are spread over the
+two years before `--until`, which is now unless a seed is given, when it
+defaults to UNTIL so that the output doesn't depend on the day it's run.
+
+Followers follow a power law: the k-th most popular user is followed with
+weight about k ** -alpha. Follow pairs are drawn per follower, so no list of
+every possible pair is ever built.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, get_power_law_rank, get_rank_scrambler
 
 MAX_WARBLER_LENGTH = 140
 
@@ -22,9 +43,21 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+# the skew of the follower distribution; higher makes celebrities bigger
+FOLLOWERS_ALPHA = 1.0
+
+# the newest message timestamp when a seed is given
+UNTIL = datetime(2020, 1, 1)
+
+# rows (or, for follows, followers) per unit of work
+CHUNK_ROWS = 100000
+
+# power-law draws per follow before falling back to evenly random users
+MAX_DRAWS_PER_FOLLOW = 20
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +65,186 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Random header image URLs to use for users
 
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    f"https://picsum.photos/id/{i}/1200/400"
+    for i in range(10, 55)
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def get_rng(seed, kind, chunk):
+    """Return the random generator for one chunk of one file."""
+
+    return random.Random(f"{seed}-{kind}-{chunk}")
+
+
+def write_users(path, chunk, start, stop, seed):
+    """Write users `start` to `stop` (ids are 1 more) to `path`."""
+
+    rng = get_rng(seed, 'users', chunk)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+
+        for i in range(start, stop):
+            # the row number keeps emails and usernames unique at any scale
+            users_writer.writerow(dict(
+                email=f"{i}.{fake.email()}",
+                username=f"{fake.user_name()}{i}",
+                image_url=rng.choice(image_urls),
+                password=PASSWORD,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(header_image_urls),
+                location=fake.city()
+            ))
+
+
+def write_messages(path, chunk, start, stop, seed, num_users, until):
+    """Write messages `start` to `stop` to `path`, by random users."""
+
+    rng = get_rng(seed, 'messages', chunk)
+    fake = Faker()
+    fake.seed_instance(rng.random())
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+
+        for i in range(start, stop):
+            messages_writer.writerow(dict(
+                text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(until, rng=rng),
+                user_id=rng.randint(1, num_users)
+            ))
+
+
+def sample_followees(rng, follower, count, num_users, alpha, get_user_id):
+    """Return `count` distinct users for `follower` to follow.
+
+    Popular users are drawn from the power law; if too many draws are
+    repeats (the follower already follows most of the popular users), the
+    rest are drawn evenly.
+    """
+
+    followees = set()
+    draws = 0
+
+    while len(followees) < count and draws < count * MAX_DRAWS_PER_FOLLOW:
+        draws += 1
+        user_id = get_user_id(get_power_law_rank(rng, num_users, alpha))
+
+        if user_id != follower:
+            followees.add(user_id)
+
+    while len(followees) < count:
+        user_id = rng.randint(1, num_users)
+
+        if user_id != follower:
+            followees.add(user_id)
+
+    return followees
+
+
+def write_follows(path, chunk, start, stop, seed, num_users, num_follows, alpha):
+    """Write the follows of followers `start` to `stop` (ids are 1 more).
+
+    Every follower follows the same number of users, give or take one, so
+    each chunk knows how many to write without asking the others. The pairs
+    of different chunks have different followers, so can't collide.
+    """
+
+    rng = get_rng(seed, 'follows', chunk)
+    get_user_id = get_rank_scrambler(num_users)
+    per_follower, remainder = divmod(num_follows, num_users)
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+
+        for i in range(start, stop):
+            follower = i + 1
+            count = per_follower + (1 if i < remainder else 0)
+
+            for followed_user in sample_followees(rng, follower, count,
+                                                  num_users, alpha, get_user_id):
+                follows_writer.writerow(dict(user_being_followed_id=followed_user,
+                                             user_following_id=follower))
+
+
+def write_csv(executor, path, headers, num_rows, write_chunk, *args):
+    """Write a CSV of `num_rows` rows, generated in parallel in chunks.
+
+    `write_chunk(part_path, chunk, start, stop, *args)` writes the rows
+    (without a header) of one chunk to its own part file.
+    """
+
+    started = time.monotonic()
+    chunks = list(enumerate(range(0, num_rows, CHUNK_ROWS)))
+    part_paths = [f"{path}.part{chunk}" for chunk, _ in chunks]
+
+    futures = [executor.submit(write_chunk, part_path, chunk, start,
+                               min(start + CHUNK_ROWS, num_rows), *args)
+               for part_path, (chunk, start) in zip(part_paths, chunks)]
+
+    with open(path, 'w', newline='') as output:
+        csv.writer(output).writerow(headers)
+
+        for part_path, future in zip(part_paths, futures):
+            future.result()
+
+            with open(part_path) as part:
+                shutil.copyfileobj(part, output)
+
+            os.remove(part_path)
+
+    print(f"Wrote {path} in {time.monotonic() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate CSVs of random data for Warbler.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--alpha', type=float, default=FOLLOWERS_ALPHA,
+                        help="power-law exponent of the follower distribution")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', default=None,
+                        help="make the output repeatable")
+    parser.add_argument('--until', type=datetime.fromisoformat, default=None,
+                        help="newest message timestamp, e.g. 2020-01-01 "
+                             "(default: now, or 2020-01-01 with --seed)")
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory to write the CSVs to")
+    args = parser.parse_args()
+
+    if args.users < 2 or args.follows > args.users * (args.users - 1):
+        parser.error("there must be at least 2 users, and fewer follows "
+                     "than there are pairs of users")
+
+    seed = args.seed if args.seed is not None else random.random()
+
+    if args.until is not None:
+        until = args.until
+    elif args.seed is not None:
+        until = UNTIL
+    else:
+        until = datetime.now()
+    os.makedirs(args.out, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        write_csv(executor, os.path.join(args.out, 'users.csv'),
+                  USERS_CSV_HEADERS, args.users, write_users, seed)
+
+        write_csv(executor, os.path.join(args.out, 'messages.csv'),
+                  MESSAGES_CSV_HEADERS, args.messages, write_messages,
+                  seed, args.users, until)
+
+        # follows are generated per follower, so chunk the users
+        write_csv(executor, os.path.join(args.out, 'follows.csv'),
+                  FOLLOWS_CSV_HEADERS, args.users, write_follows,
+                  seed, args.users, args.follows, args.alpha)
+
+
+if __name__ == '__main__':
+    main()
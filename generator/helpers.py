@@ -1,14 +1,45 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import timedelta
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(until, year_gap=2, rng=random):
+    """Get a random datetime within the few years before `until`."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    span = timedelta(days=365 * year_gap)
 
-    return datetime.fromtimestamp(random_timestamp)
+    return until - rng.uniform(0, 1) * span
+
+
+def get_power_law_rank(rng, n, alpha):
+    """Pick a rank from 1 to `n`, rank k having weight about k ** -alpha.
+
+    Uses the inverse CDF of a continuous power law, so it takes constant
+    time and memory however large `n` is.
+    """
+
+    u = rng.random()
+
+    if alpha == 1:
+        x = (n + 1) ** u
+    else:
+        x = (((n + 1) ** (1 - alpha) - 1) * u + 1) ** (1 / (1 - alpha))
+
+    return min(int(x), n)
+
+
+def get_rank_scrambler(n):
+    """Return a function mapping ranks 1..n onto user ids 1..n.
+
+    Without it the most followed users would all have the lowest ids. The
+    mapping is a fixed stride through the ids, so nothing is stored.
+    """
+
+    stride = 7919
+
+    while gcd(stride, n) != 1:
+        stride += 1
+
+    return lambda rank: (rank - 1) * stride % n + 1
@@ -0,0 +1,91 @@
+"""HTTP caching for Warbler.
+
+Static files are linked with `static_url`, which adds a fingerprint of the
+file's contents to the URL (`/static/stylesheets/style.css?v=3f2a...`).
+Fingerprinted URLs change whenever the file does, so `add_cache_headers`
+lets browsers and CDNs keep them for a year.
+
+Public pages that are cheap to version (a message, a user's profile) are
+served through `conditional_page`. It builds a strong ETag from the data
+the page is rendered from, plus who's looking, and answers a matching
+If-None-Match with a 304 before the page is rendered. Everything else is
+marked uncacheable, as before.
+"""
+
+import hashlib
+import os
+from functools import lru_cache
+
+from flask import current_app, g, make_response, request, session, url_for
+
+# a year, the longest lifetime HTTP caches are expected to honor
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@lru_cache(maxsize=None)
+def get_fingerprint(path, mtime):
+    """Return a short hash of the file at `path` (as of `mtime`)."""
+
+    with open(path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()[:12]
+
+
+def static_url(filename):
+    """Return the fingerprinted URL of a static file."""
+
+    path = os.path.join(current_app.static_folder, filename)
+
+    return url_for('static', filename=filename,
+                   v=get_fingerprint(path, os.path.getmtime(path)))
+
+
+def make_etag(*versions):
+    """Return an ETag for the current page rendered from `versions`.
+
+    The viewer's own cached fields (shown in the nav bar) and the full path,
+    including any pagination cursor, are part of the tag too.
+    """
+
+    viewer = g.user and (g.user.id, g.user.username, g.user.image_url)
+    key = repr((request.full_path, viewer, versions)).encode('utf-8')
+
+    return hashlib.sha1(key).hexdigest()
+
+
+def conditional_page(etag, render):
+    """Return a 304 if the client already has `etag`, else `render()`'s page.
+
+    Pages with pending flash messages are always rendered, untagged, so the
+    messages aren't lost.
+    """
+
+    if '_flashes' in session:
+        return render()
+
+    if request.if_none_match.contains(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+
+    # viewer-specific, so only the browser may keep it, and must revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
+
+
+def add_cache_headers(response):
+    """Set caching headers on responses that haven't set their own."""
+
+    if request.endpoint == 'static':
+        if 'v' in request.args:
+            response.headers['Cache-Control'] = (
+                f"public, max-age={STATIC_MAX_AGE}, immutable")
+
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    return response
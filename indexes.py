@@ -0,0 +1,203 @@
+"""Index and schema maintenance for Warbler.
+
+`db.create_all()` only creates indexes and columns along with new tables,
+so databases created before one was added to models.py won't have it.
+`add_missing_columns` adds the columns (run it as `flask upgrade-schema`,
+which also recounts the User counters), and `create_missing_indexes` the
+indexes (run it as `flask create-indexes`, after upgrading). Likes used to
+have a surrogate id as their key; `rekey_likes`, also run by
+`flask upgrade-schema`, removes duplicate likes and keys them on
+(user_id, message_id) instead.
+
+`find_seq_scans` runs EXPLAIN on the queries behind the hot routes and
+reports any that fall back to a sequential scan of a large table (run it as
+`flask check-query-plans` against a database seeded with realistic volumes;
+on a near-empty database PostgreSQL will rightly prefer seq scans).
+"""
+
+from sqlalchemy import inspect
+from sqlalchemy.schema import CreateColumn
+
+from models import db, User, Message, Follows, Likes, TimelineEntry
+from pagination import MESSAGES_PAGE_SIZE, USERS_PAGE_SIZE
+
+# tables that must never be sequentially scanned by a hot query
+LARGE_TABLES = {'messages', 'follows', 'likes', 'timeline_entries'}
+
+
+def add_missing_columns():
+    """Add any column declared in models.py that an existing table lacks.
+
+    New columns must be nullable or have a server default, which fills in
+    the existing rows. Returns the names ("table.column") of the columns
+    added.
+    """
+
+    inspector = inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    added = []
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name not in existing:
+                    definition = CreateColumn(column).compile(dialect=conn.dialect)
+                    conn.execute(f"ALTER TABLE {table.name} ADD COLUMN {definition}")
+                    added.append(f"{table.name}.{column.name}")
+
+    return added
+
+
+def rekey_likes():
+    """Key an old likes table on (user_id, message_id) instead of its id.
+
+    Duplicate likes (which the old key allowed) are deleted first, keeping
+    the oldest, along with likes missing a user or message. PostgreSQL
+    only; elsewhere, recreate the table instead. Returns whether the table
+    was changed.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        return False
+
+    inspector = inspect(db.engine)
+    key = inspector.get_pk_constraint(Likes.__tablename__)
+
+    if key['constrained_columns'] == ['user_id', 'message_id']:
+        return False
+
+    with db.engine.begin() as conn:
+        conn.execute("LOCK TABLE likes IN ACCESS EXCLUSIVE MODE")
+        conn.execute("DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL")
+        conn.execute("""
+            DELETE FROM likes AS newer
+            USING likes AS older
+            WHERE newer.user_id = older.user_id
+              AND newer.message_id = older.message_id
+              AND newer.id > older.id
+        """)
+        conn.execute(f"ALTER TABLE likes DROP CONSTRAINT {key['name']}")
+        conn.execute("ALTER TABLE likes DROP COLUMN id")
+        conn.execute("ALTER TABLE likes ADD PRIMARY KEY (user_id, message_id)")
+
+    return True
+
+
+def create_missing_indexes():
+    """Create any index declared in models.py that the database lacks.
+
+    Returns the names of the indexes created.
+    """
+
+    inspector = inspect(db.engine)
+    created = []
+
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+    return created
+
+
+class NoSampleData(Exception):
+    """Raised when there are no users or messages to build sample queries from."""
+
+
+def get_hot_queries():
+    """Return {description: query} for the queries behind the hot routes.
+
+    Sample ids are taken from the busiest user, so the plans reflect the
+    worst case. Raises NoSampleData on a database without messages.
+    """
+
+    user = User.query.order_by(User.followers_count.desc()).first()
+
+    if user is None:
+        raise NoSampleData("There are no users to sample; seed the database first.")
+
+    msg = (Message.query.filter(Message.user_id != user.id).first()
+           or Message.query.first())
+
+    if msg is None:
+        raise NoSampleData("There are no messages to sample; seed the database first.")
+
+    return {
+        'home timeline': (Message
+                          .query
+                          .join(TimelineEntry,
+                                TimelineEntry.message_id == Message.id)
+                          .filter(TimelineEntry.user_id == user.id)
+                          .order_by(TimelineEntry.timestamp.desc(),
+                                    TimelineEntry.message_id.desc())
+                          .limit(MESSAGES_PAGE_SIZE + 1)),
+        'profile messages': (Message
+                             .query
+                             .filter(Message.user_id == user.id)
+                             .order_by(Message.timestamp.desc(),
+                                       Message.id.desc())
+                             .limit(MESSAGES_PAGE_SIZE + 1)),
+        'followers list': (db.session
+                           .query(Follows.user_following_id)
+                           .filter(Follows.user_being_followed_id == user.id)
+                           .limit(USERS_PAGE_SIZE + 1)),
+        'following ids': (db.session
+                          .query(Follows.user_being_followed_id)
+                          .filter(Follows.user_following_id == user.id)),
+        'like toggle': (Likes
+                        .query
+                        .filter(Likes.user_id == user.id,
+                                Likes.message_id == msg.id)),
+        'message likers': (db.session
+                           .query(Likes.user_id)
+                           .filter(Likes.message_id == msg.id)),
+    }
+
+
+def explain(query):
+    """Return PostgreSQL's JSON query plan for `query`."""
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+
+    # run it as raw SQL so the bind parameters go straight to the driver
+    result = db.session.connection().execute(
+        f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params)
+
+    return result.scalar()[0]['Plan']
+
+
+def get_seq_scans(plan):
+    """Return names of large tables that `plan` (or a subplan) seq scans."""
+
+    tables = set()
+
+    if (plan['Node Type'] == 'Seq Scan'
+            and plan.get('Relation Name') in LARGE_TABLES):
+        tables.add(plan['Relation Name'])
+
+    for subplan in plan.get('Plans', []):
+        tables |= get_seq_scans(subplan)
+
+    return tables
+
+
+def find_seq_scans():
+    """Return {description: tables} for each hot query that seq scans."""
+
+    regressions = {}
+
+    for description, query in get_hot_queries().items():
+        tables = get_seq_scans(explain(query))
+
+        if tables:
+            regressions[description] = sorted(tables)
+
+    return regressions
@@ -0,0 +1,180 @@
+"""SQL instrumentation for Warbler.
+
+`init_instrumentation` hooks SQLAlchemy engine events so that, for every
+request, the app records how many statements ran and how long they took.
+Each request is logged as one JSON line on the "warbler.sql" logger, and
+per-route totals are kept for the /metrics endpoint. A statement repeated
+N_PLUS_ONE_THRESHOLD or more times in one request (the same SQL, different
+parameters, e.g. a lazy load of `msg.user` per message) is flagged as an
+N+1 pattern and logged as a warning.
+
+Those totals are internal, so /metrics is wrapped in `require_metrics_access`:
+it's only served in debug mode or to requests carrying the METRICS_TOKEN
+app config setting as a bearer token, and is a 404 otherwise.
+
+`count_queries` records every SQL statement an engine runs inside a block.
+Tests use it (through testing.QueryBudgetMixin) to hold routes to a query
+budget.
+"""
+
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# a statement run this many times in one request is reported as an N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+logger = logging.getLogger('warbler.sql')
+
+# per-endpoint totals for this process, shown by /metrics
+route_stats = defaultdict(lambda: dict(requests=0,
+                                       statements=0,
+                                       db_time_ms=0.0,
+                                       max_statements=0,
+                                       n_plus_one_requests=0))
+route_stats_lock = threading.Lock()
+
+
+@contextmanager
+def count_queries(engine):
+    """Collect the SQL statements run on `engine` while in the block.
+
+    Use like:
+
+        with count_queries(db.engine) as statements:
+            ...
+
+        print(len(statements))
+    """
+
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def find_repeated_statements(statements, threshold=N_PLUS_ONE_THRESHOLD):
+    """Return {statement: count} for statements run at least `threshold` times."""
+
+    return {statement: count
+            for statement, count in Counter(statements).items()
+            if count >= threshold}
+
+
+##############################################################################
+# Engine and request hooks
+
+
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    """Note when a statement started (engine event)."""
+
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    """Add a finished statement to the current request's log (engine event)."""
+
+    started = conn.info['query_start_times'].pop()
+
+    if has_request_context() and 'sql_statements' in g:
+        g.sql_statements.append((statement, time.perf_counter() - started))
+
+
+def start_request_log():
+    """Start collecting statements for this request."""
+
+    g.sql_statements = []
+
+
+def finish_request_log(response):
+    """Log this request's statements and add them to the route totals."""
+
+    statements = g.pop('sql_statements', [])
+    endpoint = request.endpoint or 'unknown'
+
+    db_time_ms = sum(duration for _, duration in statements) * 1000
+    repeated = find_repeated_statements([sql for sql, _ in statements])
+
+    with route_stats_lock:
+        stats = route_stats[endpoint]
+        stats['requests'] += 1
+        stats['statements'] += len(statements)
+        stats['db_time_ms'] += db_time_ms
+        stats['max_statements'] = max(stats['max_statements'], len(statements))
+        stats['n_plus_one_requests'] += bool(repeated)
+
+    logger.info(json.dumps(dict(event='request_sql',
+                                endpoint=endpoint,
+                                method=request.method,
+                                status=response.status_code,
+                                statements=len(statements),
+                                db_time_ms=round(db_time_ms, 2))))
+
+    for statement, count in repeated.items():
+        logger.warning(json.dumps(dict(event='n_plus_one',
+                                       endpoint=endpoint,
+                                       count=count,
+                                       statement=statement)))
+
+    return response
+
+
+def get_route_metrics():
+    """Return a copy of the per-route totals, with averages added."""
+
+    with route_stats_lock:
+        metrics = {endpoint: dict(stats) for endpoint, stats in route_stats.items()}
+
+    for stats in metrics.values():
+        stats['avg_statements'] = round(stats['statements'] / stats['requests'], 2)
+        stats['avg_db_time_ms'] = round(stats['db_time_ms'] / stats['requests'], 2)
+        stats['db_time_ms'] = round(stats['db_time_ms'], 2)
+
+    return metrics
+
+
+def init_instrumentation(app):
+    """Record SQL statements per request for `app`.
+
+    Listens on every engine, so it also covers engines created later.
+    """
+
+    if not event.contains(Engine, 'before_cursor_execute', start_timer):
+        event.listen(Engine, 'before_cursor_execute', start_timer)
+        event.listen(Engine, 'after_cursor_execute', record_statement)
+
+    app.before_request(start_request_log)
+    app.after_request(finish_request_log)
+
+
+def require_metrics_access(view):
+    """Serve `view` only in debug mode or with the METRICS_TOKEN bearer token."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get('METRICS_TOKEN')
+        supplied = request.headers.get('Authorization', '')
+
+        if not current_app.debug and not (
+                token and hmac.compare_digest(supplied, f"Bearer {token}")):
+            abort(404)
+
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -1,12 +1,12 @@
 """SQLAlchemy models for Warbler."""
 
+from collections import namedtuple
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from passwords import password_hasher
+from replicas import RoutingSQLAlchemy
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -14,6 +14,13 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # the primary key (user_being_followed_id first) covers listing a
+    # user's followers; this covers listing who a user is following
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -32,21 +39,73 @@ class Likes(db.Model):
 
     __tablename__ = 'likes' 
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    __table_args__ = (
+        # finding who liked a message, e.g. when it is deleted
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
+    # (user_id, message_id) is the primary key, so a user can only like a
+    # message once and the like toggle can look the pair up directly
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade')
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
     )
 
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message if the user hasn't already, otherwise unlike it.
+
+        On PostgreSQL this is a single statement, so concurrent toggles
+        (e.g. a double-click) can't race each other.
+
+        Returns 1 if a like was added, -1 if one was removed, or 0 if a
+        concurrent toggle added the same like first.
+        """
+
+        params = dict(user_id=user_id, message_id=message_id)
+
+        if db.engine.dialect.name == 'postgresql':
+            return db.session.execute(TOGGLE_LIKE_SQL, params).scalar()
+
+        deleted = (cls
+                   .query
+                   .filter_by(**params)
+                   .delete(synchronize_session=False))
+
+        if deleted:
+            return -1
+
+        db.session.add(cls(**params))
+        db.session.flush()
+        return 1
+
+
+# Delete the like if it exists; otherwise insert it. Both halves see the
+# same snapshot, so "NOT EXISTS (SELECT 1 FROM deleted)" stops the insert
+# from undoing the delete.
+TOGGLE_LIKE_SQL = db.text("""
+    WITH deleted AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING 1
+    ), inserted AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, :message_id
+        WHERE NOT EXISTS (SELECT 1 FROM deleted)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM inserted) - (SELECT count(*) FROM deleted)
+""")
+
 
 class User(db.Model):
     """User in the system."""
@@ -93,6 +152,37 @@ class User(db.Model):
         nullable=False,
     )
 
+    # denormalized counts, maintained by counters.py so that profile pages
+    # don't have to load every related row just to count it
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -120,14 +210,50 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        follow = Follows.query.filter_by(user_being_followed_id=self.id,
+                                         user_following_id=other_user.id)
+        return db.session.query(follow.exists()).scalar()
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        follow = Follows.query.filter_by(user_being_followed_id=other_user.id,
+                                         user_following_id=self.id)
+        return db.session.query(follow.exists()).scalar()
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+    def has_liked(self, message):
+        """Has this user liked `message`?"""
+
+        like = Likes.query.filter_by(user_id=self.id, message_id=message.id)
+        return db.session.query(like.exists()).scalar()
+
+    def get_following_ids(self, among=None):
+        """Return the set of ids of users this user is following.
+
+        Use this rather than `self.following` when only checking membership,
+        since it doesn't load the followed users themselves. With `among`,
+        only those user ids are checked.
+        """
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id))
+
+        if among is not None:
+            if not among:
+                return set()
+
+            rows = rows.filter(Follows.user_being_followed_id.in_(among))
+
+        return {user_id for (user_id,) in rows}
+
+    def get_liked_message_ids(self):
+        """Return the set of ids of messages this user has liked."""
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id))
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -136,7 +262,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -157,23 +283,63 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the password was hashed at a different bcrypt cost than the one
+        now configured, it's rehashed; the caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
 
 
+USER_CARD_FIELDS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+class UserCard(namedtuple('UserCard', USER_CARD_FIELDS)):
+    """The columns of a User shown on its card in user lists.
+
+    Much lighter to load than a User, and leaves the password hash in the
+    database. Query for cards with `UserCard.query()` and turn the rows
+    into cards with `UserCard.from_rows()`.
+    """
+
+    __slots__ = ()
+
+    @staticmethod
+    def query():
+        """Return a query selecting just the card columns of users."""
+
+        return db.session.query(*[getattr(User, field)
+                                  for field in USER_CARD_FIELDS])
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Return a list of cards from rows of `query()`."""
+
+        return [cls._make(row) for row in rows]
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        # profile pages and celebrity timeline merges: a user's messages,
+        # newest first (see pagination.py)
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        # everyone's messages, newest first (see search.search_messages)
+        db.Index('ix_messages_timestamp_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -187,7 +353,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,6 +365,57 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_id_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so the timeline can be ordered without
+    # touching the messages table
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class RateLimitBucket(db.Model):
+    """A token bucket shared between processes (see ratelimit.py)."""
+
+    __tablename__ = 'rate_limit_buckets'
+
+    key = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    tokens = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
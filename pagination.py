@@ -0,0 +1,134 @@
+"""Keyset (cursor) pagination helpers for Warbler.
+
+Message feeds are ordered newest first on (timestamp, id) and continue
+"before" a cursor naming the last message shown. User lists are ordered on
+id and continue "after" the last id shown. Either way, each page is a
+range scan from the cursor rather than an OFFSET, so later pages cost the
+same as the first.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+MESSAGES_PAGE_SIZE = 100
+USERS_PAGE_SIZE = 60
+
+CURSOR_TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+
+def encode_message_cursor(msg):
+    """Return the cursor for continuing a feed after `msg`."""
+
+    return f"{msg.timestamp.isoformat()}_{msg.id}"
+
+
+def decode_message_cursor(cursor):
+    """Return (timestamp, id) from a message cursor.
+
+    Returns None if there is no cursor or it can't be read, which callers
+    treat as "start from the newest message".
+    """
+
+    if not cursor:
+        return None
+
+    timestamp, _, msg_id = cursor.rpartition('_')
+
+    if not msg_id.isdigit():
+        return None
+
+    for timestamp_format in CURSOR_TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(timestamp, timestamp_format), int(msg_id)
+        except ValueError:
+            pass
+
+    return None
+
+
+def messages_before(timestamp_col, id_col, cursor):
+    """Return a filter for rows that come after `cursor` in a newest-first feed."""
+
+    timestamp, msg_id = cursor
+
+    return or_(timestamp_col < timestamp,
+               and_(timestamp_col == timestamp, id_col < msg_id))
+
+
+def paginate_messages(query, timestamp_col, id_col, before=None,
+                      limit=MESSAGES_PAGE_SIZE):
+    """Return one newest-first page of `query` and the cursor for the next.
+
+    `query` must return Message objects; `timestamp_col` and `id_col` are
+    the columns it should be ordered on. The next cursor is None on the
+    last page.
+    """
+
+    messages = page_query(query, timestamp_col, id_col, before, limit).all()
+
+    return page_of(messages, limit, encode_message_cursor)
+
+
+def page_query(query, timestamp_col, id_col, before=None,
+               limit=MESSAGES_PAGE_SIZE):
+    """Return `query` narrowed to the rows for one page after `before`.
+
+    The rows come newest first, with one extra row past the page to find
+    out whether there's another.
+    """
+
+    cursor = decode_message_cursor(before)
+
+    if cursor:
+        query = query.filter(messages_before(timestamp_col, id_col, cursor))
+
+    return (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1))
+
+
+def paginate_users(query, id_col, after=None, limit=USERS_PAGE_SIZE):
+    """Return one page of `query` in id order and the cursor for the next."""
+
+    if after and after.isdigit():
+        query = query.filter(id_col > int(after))
+
+    users = query.order_by(id_col).limit(limit + 1).all()
+
+    return page_of(users, limit, lambda user: str(user.id))
+
+
+def page_of(rows, limit, encode_cursor):
+    """Trim `rows` (fetched with limit + 1) to a page and its next cursor."""
+
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1])
+
+    return rows, None
+
+
+class StreamedPage:
+    """A page whose rows are produced while it's iterated, e.g. by a template.
+
+    `rows` yields up to limit + 1 rows, like the queries above. Once the
+    page has been iterated, `next_cursor` is the cursor for the next page
+    (None on the last page).
+    """
+
+    def __init__(self, rows, limit, encode_cursor):
+        self.rows = rows
+        self.limit = limit
+        self.encode_cursor = encode_cursor
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+
+        for count, row in enumerate(self.rows):
+            if count == self.limit:
+                self.next_cursor = self.encode_cursor(last)
+                return
+
+            last = row
+            yield row
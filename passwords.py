@@ -0,0 +1,160 @@
+"""Password hashing for Warbler.
+
+bcrypt is deliberately slow (around 250ms of CPU per hash at cost 12), so a
+burst of logins hashing on every request thread at once would take all the
+host's cores from other requests. `PasswordHasher` runs hashes on a small
+pool of threads instead (bcrypt releases the GIL while it works), capping
+how many run at once in each web process.
+
+Every web process (e.g. each gunicorn worker) has its own pool. By default
+each gets an even share of the CPUs: their number divided by
+WEB_CONCURRENCY, the number of web processes, so that between them the
+pools use each core once.
+
+The pool is bounded: if PASSWORD_HASH_MAX_PENDING hashes are already queued
+or running, new ones wait up to PASSWORD_HASH_QUEUE_TIMEOUT seconds and then
+raise `PasswordHasherBusy`, rather than letting a burst of logins queue up
+without limit.
+
+Settings (app config, all optional):
+
+    BCRYPT_LOG_ROUNDS            bcrypt cost for new hashes (default 12)
+    PASSWORD_HASH_WORKERS        hashing threads; 0 hashes on the calling
+                                 thread (default: see `get_default_workers`)
+    PASSWORD_HASH_MAX_PENDING    hashes queued or running at once
+                                 (default: 4 per worker)
+    PASSWORD_HASH_QUEUE_TIMEOUT  seconds to wait for room in the queue
+                                 (default 2)
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+BCRYPT_LOG_ROUNDS = 12
+PASSWORD_HASH_QUEUE_TIMEOUT = 2
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many password hashes are already waiting."""
+
+
+def get_default_workers():
+    """Return this process's share of the CPUs, given WEB_CONCURRENCY processes."""
+
+    web_processes = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+    return max(1, (os.cpu_count() or 1) // max(web_processes, 1))
+
+
+def hash_password(password, rounds):
+    """Return the bcrypt hash of `password`."""
+
+    salt = bcrypt.gensalt(rounds)
+
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match `hashed`?"""
+
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # not a bcrypt hash
+        return False
+
+
+def get_rounds(hashed):
+    """Return the cost a bcrypt hash was made with, e.g. 12 for "$2b$12$..."."""
+
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded pool of threads.
+
+    Set up like a Flask extension: create it at import time and call
+    `init_app` to read settings from the app's config.
+    """
+
+    def __init__(self, app=None):
+        self.rounds = BCRYPT_LOG_ROUNDS
+        self.workers = get_default_workers()
+        self.max_pending = self.workers * 4
+        self.queue_timeout = PASSWORD_HASH_QUEUE_TIMEOUT
+
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self.max_pending = app.config.get('PASSWORD_HASH_MAX_PENDING',
+                                          max(self.workers, 1) * 4)
+        self.queue_timeout = app.config.get('PASSWORD_HASH_QUEUE_TIMEOUT',
+                                            self.queue_timeout)
+
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+
+    def get_pool(self):
+        """Return the worker pool, starting it on first use."""
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix='bcrypt')
+
+            return self.pool
+
+    def run(self, func, *args):
+        """Run `func(*args)` in the pool (or inline with no workers)."""
+
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise PasswordHasherBusy()
+
+        try:
+            if not self.workers:
+                return func(*args)
+
+            return self.get_pool().submit(func, *args).result()
+
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self.run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self.run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different cost than the configured one?"""
+
+        return get_rounds(hashed) != self.rounds
+
+    def shutdown(self):
+        """Stop the hashing threads, e.g. when a benchmark finishes."""
+
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+password_hasher = PasswordHasher()
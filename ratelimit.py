@@ -0,0 +1,195 @@
+"""Token-bucket rate limiting for Warbler's password checks.
+
+Every login attempt costs a full bcrypt check, so a credential-stuffing
+burst can tie up every hashing worker. `login_limiter` is checked before
+the hash starts. It keeps one bucket per username and one per client IP,
+and an attempt is refused if either bucket is empty. A bucket holds up to
+`capacity` tokens and refills at `capacity` tokens per `period` seconds,
+so short bursts are allowed but sustained guessing is not. Only failed
+attempts should cost anything, so a successful one gives its tokens back
+with `refund`.
+
+The IP is the client's address as the app sees it. Behind a load balancer
+or reverse proxy, that's the proxy's, unless TRUSTED_PROXY_HOPS is set in
+app.py to have the client's address read from X-Forwarded-For.
+
+Buckets live in this process's memory by default. With RATE_LIMIT_STORE set
+to "database", they're kept in the `rate_limit_buckets` table instead, so
+every process shares the same limits (PostgreSQL only). A missing bucket
+counts as full, so rows can be deleted at any time.
+
+Settings (app config, all optional):
+
+    LOGIN_RATE_LIMITS  {'username': (capacity, period),
+                        'ip': (capacity, period)}
+    RATE_LIMIT_STORE   "memory" (default) or "database"
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from sqlalchemy import text
+
+from models import db
+
+LOGIN_RATE_LIMITS = {
+    'username': (5, 60),
+    'ip': (20, 60),
+}
+
+# Most buckets kept in memory at once, least recently used dropped first
+MAX_BUCKETS = 100000
+
+# Counters for this process: how many attempts were checked, and how many
+# were refused by each kind of bucket.
+stats = Counter()
+
+TAKE_TOKEN_SQL = text("""
+    INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at)
+    VALUES (:key, :capacity - 1, now())
+    ON CONFLICT (key) DO UPDATE
+    SET tokens = LEAST(:capacity, b.tokens + :rate *
+                       EXTRACT(EPOCH FROM now() - b.updated_at)) - 1,
+        updated_at = now()
+    WHERE LEAST(:capacity, b.tokens + :rate *
+                EXTRACT(EPOCH FROM now() - b.updated_at)) >= 1
+    RETURNING tokens
+""")
+
+GIVE_TOKEN_SQL = text("""
+    UPDATE rate_limit_buckets
+    SET tokens = LEAST(:capacity, tokens + 1)
+    WHERE key = :key
+""")
+
+
+class MemoryBucketStore:
+    """Token buckets in this process's memory."""
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        """Take a token from bucket `key` if it has one; return whether it did."""
+
+        now = time.monotonic()
+
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+
+            allowed = tokens >= 1
+
+            if allowed:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+
+        return allowed
+
+    def give(self, key, capacity):
+        """Put a token back in bucket `key`."""
+
+        with self.lock:
+            if key in self.buckets:
+                tokens, updated_at = self.buckets[key]
+                self.buckets[key] = (min(capacity, tokens + 1), updated_at)
+
+    def clear(self):
+        """Refill every bucket."""
+
+        with self.lock:
+            self.buckets.clear()
+
+
+class DatabaseBucketStore:
+    """Token buckets in the `rate_limit_buckets` table, shared by processes."""
+
+    def take(self, key, capacity, rate):
+        """Take a token from bucket `key` if it has one; return whether it did."""
+
+        # its own transaction, so the token stays taken even if the
+        # request's transaction is rolled back
+        with db.engine.begin() as conn:
+            row = conn.execute(TAKE_TOKEN_SQL,
+                               key=key,
+                               capacity=capacity,
+                               rate=rate).first()
+
+        return row is not None
+
+    def give(self, key, capacity):
+        """Put a token back in bucket `key`."""
+
+        with db.engine.begin() as conn:
+            conn.execute(GIVE_TOKEN_SQL, key=key, capacity=capacity)
+
+    def clear(self):
+        """Refill every bucket."""
+
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM rate_limit_buckets"))
+
+
+class RateLimiter:
+    """Limits attempts per key, e.g. per username and per client IP.
+
+    Set up like a Flask extension: create it at import time and call
+    `init_app` to read settings from the app's config.
+    """
+
+    def __init__(self, limits, app=None):
+        self.limits = limits
+        self.store = MemoryBucketStore()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Read settings from `app.config`."""
+
+        self.limits = app.config.get('LOGIN_RATE_LIMITS', self.limits)
+
+        if app.config.get('RATE_LIMIT_STORE') == 'database':
+            self.store = DatabaseBucketStore()
+
+    def allow(self, **keys):
+        """May an attempt go ahead? Takes a token from each key's bucket.
+
+        Call like `allow(ip='10.0.0.1', username='jane')`. Buckets are
+        checked in that order, and once one refuses, the rest are left alone.
+        """
+
+        stats['checked'] += 1
+
+        for kind, value in keys.items():
+            capacity, period = self.limits[kind]
+
+            if not self.store.take(f"{kind}:{value}", capacity, capacity / period):
+                stats['rejected'] += 1
+                stats[f'rejected_by_{kind}'] += 1
+                return False
+
+        return True
+
+    def refund(self, **keys):
+        """Give back the tokens `allow` took, e.g. when a login succeeds."""
+
+        for kind, value in keys.items():
+            capacity, period = self.limits[kind]
+            self.store.give(f"{kind}:{value}", capacity)
+
+    def reset(self):
+        """Refill every bucket."""
+
+        self.store.clear()
+
+
+login_limiter = RateLimiter(LOGIN_RATE_LIMITS)
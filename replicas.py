@@ -0,0 +1,109 @@
+"""Routing reads to read replicas.
+
+Replicas are listed in DATABASE_REPLICA_URLS (comma-separated), which
+app.py turns into SQLALCHEMY_BINDS entries named in REPLICA_BINDS. Each
+request is given a database before anything else runs:
+
+- GET and HEAD requests read from a replica, chosen at random per request
+  so that all of a page's queries see the same snapshot.
+- Other requests (form posts, which write) use the primary.
+- So that users see their own writes despite replication lag, their
+  requests keep using the primary for REPLICA_LAG_SECONDS after a write
+  (the replicas should have caught up by then). The deadline is kept in
+  the user's session.
+
+Flushes always go to the primary, so a request that turns out to write
+still writes to the right place. Work outside requests (CLI commands,
+tests) uses the primary. With no replicas configured, everything does.
+"""
+
+import random
+import time
+from collections import Counter
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import orm
+
+from dbpool import PooledSQLAlchemy
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+# session key holding the time until which the user's requests must use
+# the primary
+READ_PRIMARY_KEY = 'read_primary_until'
+
+# Default seconds after a write that the writer keeps reading the primary
+REPLICA_LAG_SECONDS = 5
+
+# Counters for this process: requests served from replicas and from the
+# primary, and of the latter how many were only there to read a write.
+stats = Counter()
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the request's replica, if it was given one."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = has_request_context() and g.get('db_replica')
+
+        if replica and not self._flushing:
+            return get_state(self.app).db.get_engine(self.app, bind=replica)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def get_replica_binds(app):
+    """Return the bind keys of `app`'s replicas."""
+
+    return app.config.get('REPLICA_BINDS', [])
+
+
+def choose_database():
+    """Pick the database this request reads from (see module docstring)."""
+
+    if request.endpoint == 'static':
+        return
+
+    read_primary = False
+
+    # only touch the session if the key is there, so it isn't resent
+    if READ_PRIMARY_KEY in session:
+        read_primary = time.time() < session[READ_PRIMARY_KEY]
+
+        if not read_primary:
+            session.pop(READ_PRIMARY_KEY)
+
+    replicas = get_replica_binds(current_app)
+
+    if request.method in SAFE_METHODS and replicas and not read_primary:
+        g.db_replica = random.choice(replicas)
+        stats['replica_requests'] += 1
+    else:
+        g.db_replica = None
+        stats['primary_requests'] += 1
+        stats['read_your_writes'] += read_primary
+
+
+def remember_write(response):
+    """Send the user's requests to the primary for a while if this one could write."""
+
+    if request.method not in SAFE_METHODS:
+        lag = current_app.config.get('REPLICA_LAG_SECONDS', REPLICA_LAG_SECONDS)
+        session[READ_PRIMARY_KEY] = time.time() + lag
+
+    return response
+
+
+def init_replicas(app):
+    """Route `app`'s read-only requests to its replicas."""
+
+    app.before_request(choose_database)
+    app.after_request(remember_write)
@@ -0,0 +1,536 @@
+"""Search for Warbler.
+
+Messages are searched by word prefixes. On PostgreSQL this uses a GIN
+index over `to_tsvector(text)`; elsewhere an in-process inverted index.
+
+Users are searched by username, bio and location. On PostgreSQL with the
+pg_trgm extension, substring matches are found through trigram GIN indexes
+and ranked by trigram similarity, weighted towards the username. (The
+PostgreSQL indexes are created by `flask create-indexes`.)
+
+On PostgreSQL without pg_trgm, users are found with a plain ILIKE filter in
+id order, so the scan stops as soon as a page of matches is found; results
+aren't ranked.
+
+Elsewhere (e.g. SQLite) user search runs against an
+in-process n-gram index. It's loaded from the database on first use and
+kept up to date by ORM events. Only the requested page of users is loaded,
+and matches are re-checked against the database, so entries left stale by
+bulk updates or other processes never produce wrong results; at worst a
+user added outside this process is missed until restart. Searches too
+short to have any n-grams use the ILIKE filter instead.
+"""
+
+import bisect
+import re
+from collections import defaultdict
+
+from sqlalchemy import event, or_
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User, UserCard, Message
+from pagination import (USERS_PAGE_SIZE, MESSAGES_PAGE_SIZE,
+                        paginate_messages, decode_message_cursor,
+                        messages_before)
+
+USER_SEARCH_FIELDS = ('username', 'bio', 'location')
+
+# username matches count for more than bio or location matches
+USERNAME_WEIGHT = 2
+USER_SEARCH_WEIGHTS = (USERNAME_WEIGHT, 1, 1)
+
+
+##############################################################################
+# In-process n-gram index
+
+
+def get_ngrams(text, n=3, pad=True):
+    """Return the set of lowercased `n`-character substrings of `text`'s words.
+
+    With `pad`, each word is padded with spaces first (as pg_trgm does), so
+    that the starts and ends of words get their own n-grams.
+    """
+
+    words = text.lower().split()
+
+    if pad:
+        words = [f"  {word} " for word in words]
+
+    return {word[i:i + n] for word in words for i in range(len(word) - n + 1)}
+
+
+def get_similarity(a_ngrams, b_ngrams):
+    """Return the similarity (0 to 1) of two sets of n-grams."""
+
+    if not a_ngrams or not b_ngrams:
+        return 0
+
+    return len(a_ngrams & b_ngrams) / len(a_ngrams | b_ngrams)
+
+
+class NgramIndex:
+    """Maps n-grams to the ids of the documents containing them.
+
+    Documents are tuples of text fields. The lowercased fields and their
+    n-grams are kept too, so matches can be checked and ranked without
+    going back to the database.
+    """
+
+    def __init__(self, n=3):
+        self.n = n
+        self.postings = defaultdict(set)
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, fields):
+        """Index `fields` under `doc_id`, replacing anything indexed before."""
+
+        self.remove(doc_id)
+
+        fields = tuple((field or '').lower() for field in fields)
+        field_ngrams = [get_ngrams(field, self.n) for field in fields]
+        self.documents[doc_id] = (fields, field_ngrams)
+
+        for ngram in set().union(*field_ngrams):
+            self.postings[ngram].add(doc_id)
+
+    def remove(self, doc_id):
+        """Remove `doc_id` from the index, if present."""
+
+        fields, field_ngrams = self.documents.pop(doc_id, ((), []))
+
+        for ngram in set().union(*field_ngrams):
+            self.postings[ngram].discard(doc_id)
+
+    def get_candidates(self, substring):
+        """Return ids of documents that may contain `substring`.
+
+        Every document containing it is returned, but not every document
+        returned contains it.
+        """
+
+        ngrams = get_ngrams(substring, self.n, pad=False)
+
+        # too short to have any n-grams, so anything could match
+        if not ngrams:
+            return set(self.documents)
+
+        postings = sorted((self.postings.get(ngram, set()) for ngram in ngrams),
+                          key=len)
+
+        return set.intersection(*postings)
+
+    def search(self, substring, weights):
+        """Return ids of documents with a field containing `substring`.
+
+        Best matches come first: each field's n-gram similarity to
+        `substring`, times that field's weight, summed.
+        """
+
+        lowered = substring.lower()
+        query_ngrams = get_ngrams(lowered, self.n)
+        ranked = []
+
+        for doc_id in self.get_candidates(lowered):
+            fields, field_ngrams = self.documents[doc_id]
+
+            if any(lowered in field for field in fields):
+                rank = sum(weight * get_similarity(query_ngrams, ngrams)
+                           for weight, ngrams in zip(weights, field_ngrams))
+                ranked.append((-rank, doc_id))
+
+        return [doc_id for _, doc_id in sorted(ranked)]
+
+
+user_index = NgramIndex()
+user_index_loaded = False
+
+
+def get_user_search_fields(user):
+    """Return the fields `user` is searched by."""
+
+    return tuple(getattr(user, field) for field in USER_SEARCH_FIELDS)
+
+
+def load_user_index():
+    """Fill the in-process user index from the database, once per process."""
+
+    global user_index_loaded
+
+    if user_index_loaded:
+        return
+
+    rows = db.session.query(User.id, *[getattr(User, field)
+                                       for field in USER_SEARCH_FIELDS])
+
+    for user_id, *fields in rows.yield_per(10000):
+        user_index.add(user_id, fields)
+
+    user_index_loaded = True
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def index_user(mapper, connection, user):
+    """Keep the in-process index in step with users saved through the ORM."""
+
+    if user_index_loaded:
+        user_index.add(user.id, get_user_search_fields(user))
+
+
+@event.listens_for(User, 'after_delete')
+def unindex_user(mapper, connection, user):
+    """Drop deleted users from the in-process index."""
+
+    if user_index_loaded:
+        user_index.remove(user.id)
+
+
+##############################################################################
+# User search
+
+
+trigram_support = None
+
+
+def has_trigram_support():
+    """Can the database do trigram searches (PostgreSQL with pg_trgm)?"""
+
+    global trigram_support
+
+    if trigram_support is None:
+        trigram_support = (
+            db.engine.dialect.name == 'postgresql'
+            and bool(db.session
+                     .execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+                     .scalar()))
+
+    return trigram_support
+
+
+def escape_like(text):
+    """Escape LIKE wildcards in `text` so it matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(search, page=1, limit=USERS_PAGE_SIZE):
+    """Return a page of users matching `search`, best match first.
+
+    A user matches if `search` appears (ignoring case) in their username,
+    bio or location. Returns (UserCards, next page number or None).
+    """
+
+    offset = (page - 1) * limit
+
+    if has_trigram_support():
+        users = search_users_trigram(search, offset, limit + 1)
+    elif db.engine.dialect.name == 'postgresql':
+        users = search_users_ilike(search, offset, limit + 1)
+    else:
+        users = search_users_ngram(search, offset, limit + 1)
+
+    if len(users) > limit:
+        return users[:limit], page + 1
+
+    return users, None
+
+
+def get_user_matches(search):
+    """Return a filter for users with `search` in a searched field."""
+
+    pattern = f"%{escape_like(search)}%"
+
+    return or_(*[getattr(User, field).ilike(pattern, escape='\\')
+                 for field in USER_SEARCH_FIELDS])
+
+
+def search_users_trigram(search, offset, limit):
+    """Search users with pg_trgm indexes."""
+
+    rank = (db.func.similarity(User.username, search) * USERNAME_WEIGHT
+            + db.func.word_similarity(search, db.func.coalesce(User.bio, ''))
+            + db.func.word_similarity(search, db.func.coalesce(User.location, '')))
+
+    return UserCard.from_rows(UserCard
+                              .query()
+                              .filter(get_user_matches(search))
+                              .order_by(rank.desc(), User.id)
+                              .offset(offset)
+                              .limit(limit))
+
+
+def search_users_ilike(search, offset, limit):
+    """Search users with an ILIKE filter, in id order."""
+
+    return UserCard.from_rows(UserCard
+                              .query()
+                              .filter(get_user_matches(search))
+                              .order_by(User.id)
+                              .offset(offset)
+                              .limit(limit))
+
+
+def search_users_ngram(search, offset, limit):
+    """Search users with the in-process n-gram index."""
+
+    # with no n-grams to look up, the index would check every user
+    if not get_ngrams(search, user_index.n, pad=False):
+        return search_users_ilike(search, offset, limit)
+
+    load_user_index()
+
+    user_ids = user_index.search(search, USER_SEARCH_WEIGHTS)[offset:offset + limit]
+
+    # the index may be stale, so the database checks each match again
+    users = {user.id: user
+             for user in UserCard.from_rows(
+                 UserCard
+                 .query()
+                 .filter(User.id.in_(user_ids), get_user_matches(search)))}
+
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+
+##############################################################################
+# Message search
+
+
+# text search configuration for message text; 'simple' just lowercases
+# words, without language-specific stemming or stop words
+TS_CONFIG = db.literal_column("'simple'")
+
+# how many of the newest messages to check before falling back to the
+# full text index (see search_messages)
+RECENT_MESSAGES_WINDOW = 5000
+
+
+def get_words(text):
+    """Return the lowercased words in `text`, split as PostgreSQL would."""
+
+    return re.findall(r"[^\W_]+", text.lower())
+
+
+class InvertedIndex:
+    """Maps words to the ids of the documents containing them.
+
+    Words are also kept in sorted order, so every word starting with a
+    given prefix can be found with a binary search.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, doc_id, text):
+        """Index `text` under `doc_id`, replacing anything indexed before."""
+
+        self.remove(doc_id)
+
+        words = set(get_words(text))
+        self.documents[doc_id] = words
+
+        for word in words:
+            if word not in self.postings:
+                self.postings[word] = set()
+                bisect.insort(self.vocabulary, word)
+
+            self.postings[word].add(doc_id)
+
+    def remove(self, doc_id):
+        """Remove `doc_id` from the index, if present."""
+
+        for word in self.documents.pop(doc_id, ()):
+            self.postings[word].discard(doc_id)
+
+            if not self.postings[word]:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+
+    def get_prefix_matches(self, prefix):
+        """Return ids of documents with a word starting with `prefix`."""
+
+        matches = set()
+        start = bisect.bisect_left(self.vocabulary, prefix)
+
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+
+            matches |= self.postings[word]
+
+        return matches
+
+    def search(self, text):
+        """Return ids of documents matching every word in `text` as a prefix."""
+
+        words = get_words(text)
+
+        if not words:
+            return set()
+
+        return set.intersection(*[self.get_prefix_matches(word)
+                                  for word in words])
+
+
+message_index = InvertedIndex()
+message_index_loaded = False
+
+
+def load_message_index():
+    """Fill the in-process message index from the database, once per process."""
+
+    global message_index_loaded
+
+    if message_index_loaded:
+        return
+
+    for msg_id, text in db.session.query(Message.id, Message.text).yield_per(10000):
+        message_index.add(msg_id, text)
+
+    message_index_loaded = True
+
+
+@event.listens_for(Message, 'after_insert')
+@event.listens_for(Message, 'after_update')
+def index_message(mapper, connection, msg):
+    """Keep the in-process index in step with messages added or edited."""
+
+    if message_index_loaded:
+        message_index.add(msg.id, msg.text)
+
+
+@event.listens_for(Message, 'after_delete')
+def unindex_message(mapper, connection, msg):
+    """Drop deleted messages from the in-process index."""
+
+    if message_index_loaded:
+        message_index.remove(msg.id)
+
+
+def get_prefix_tsquery(search):
+    """Return a tsquery string matching every word of `search` as a prefix."""
+
+    return ' & '.join(f"{word}:*" for word in get_words(search))
+
+
+def search_messages(search, before=None, limit=MESSAGES_PAGE_SIZE):
+    """Return a page of messages matching `search`, newest first.
+
+    Each word of `search` must start a word of the message, so "bir" finds
+    "birds". `before` is a cursor from a previous page (see pagination.py).
+    Returns (messages, cursor for the next page or None).
+    """
+
+    if not get_words(search):
+        return [], None
+
+    if db.engine.dialect.name != 'postgresql':
+        load_message_index()
+        matches = (Message
+                   .query
+                   .filter(Message.id.in_(message_index.search(search)))
+                   .options(joinedload(Message.user)))
+
+        return paginate_messages(matches, Message.timestamp, Message.id,
+                                 before=before, limit=limit)
+
+    query = db.func.to_tsquery(TS_CONFIG, get_prefix_tsquery(search))
+
+    def matching(messages):
+        return (db.session
+                .query(messages)
+                .filter(db.func.to_tsvector(TS_CONFIG, messages.text)
+                        .op('@@')(query))
+                .options(joinedload(messages.user)))
+
+    # Common words fill a page from just the newest messages, so check
+    # those first; that's much cheaper than collecting and sorting every
+    # match. Only a page with a next cursor is known to be complete.
+    newest = aliased(Message, get_newest_messages(before).subquery())
+
+    messages, next_cursor = paginate_messages(matching(newest),
+                                              newest.timestamp,
+                                              newest.id,
+                                              before=before,
+                                              limit=limit)
+
+    if next_cursor:
+        return messages, next_cursor
+
+    # Otherwise collect every match through the text index, then sort. The
+    # OFFSET 0 subquery stops PostgreSQL from walking the whole timestamp
+    # index instead, which it can mistake for cheaper when it can't tell
+    # how rare the words are.
+    every = aliased(Message, matching(Message).offset(0).subquery())
+
+    return paginate_messages(db.session
+                             .query(every)
+                             .options(joinedload(every.user)),
+                             every.timestamp,
+                             every.id,
+                             before=before,
+                             limit=limit)
+
+
+def get_newest_messages(before=None):
+    """Return a query for the newest messages (before a cursor, if given)."""
+
+    newest = Message.query
+    cursor = decode_message_cursor(before)
+
+    if cursor:
+        newest = newest.filter(
+            messages_before(Message.timestamp, Message.id, cursor))
+
+    return (newest
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(RECENT_MESSAGES_WINDOW))
+
+
+def create_search_indexes():
+    """Create the message text index and, where possible, trigram indexes.
+
+    Returns the names of the indexes created (or that already existed).
+    Does nothing on databases other than PostgreSQL. The trigram indexes
+    are skipped if pg_trgm isn't installed on the server; user search then
+    falls back to an unranked ILIKE scan (`search_users_ilike`).
+    """
+
+    global trigram_support
+
+    if db.engine.dialect.name != 'postgresql':
+        return []
+
+    db.session.execute("CREATE INDEX IF NOT EXISTS ix_messages_text_fts "
+                       "ON messages USING gin (to_tsvector('simple', text))")
+    db.session.commit()
+
+    names = ['ix_messages_text_fts']
+
+    try:
+        db.session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DBAPIError:
+        db.session.rollback()
+        return names
+
+    for field in USER_SEARCH_FIELDS:
+        name = f"ix_users_{field}_trgm"
+        db.session.execute(f"CREATE INDEX IF NOT EXISTS {name} "
+                           f"ON users USING gin ({field} gin_trgm_ops)")
+        names.append(name)
+
+    db.session.commit()
+    trigram_support = None
+
+    return names
@@ -1,20 +1,26 @@
-"""Seed database with sample data from CSV Files."""
-
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+"""Seed database with sample data from CSV Files.
 
+Run like `python seed.py`; see `python seed.py --help` for loading another
+directory of CSVs or resuming an interrupted load. The work is done by
+bulk_import.py.
+"""
 
-db.drop_all()
-db.create_all()
+import argparse
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from app import db
+from bulk_import import import_csvs, CHUNK_SIZE
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('directory', nargs='?', default='generator',
+                    help="where users.csv, messages.csv and follows.csv are")
+parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                    help="rows sent to the database at a time")
+parser.add_argument('--resume', action='store_true',
+                    help="continue an interrupted load instead of starting over")
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+args = parser.parse_args()
 
-db.session.commit()
+try:
+    import_csvs(args.directory, chunk_size=args.chunk_size, resume=args.resume)
+except ValueError as error:
+    parser.error(str(error))
@@ -0,0 +1,144 @@
+"""JSON API view tests."""
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from timeline import rebuild_timelines
+from counters import recount
+from user_cache import user_cache
+from testing import QueryBudgetMixin
+
+db.create_all()
+
+
+class ApiViewTestCase(QueryBudgetMixin, TestCase):
+    """Test the JSON API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        Likes.query.delete()
+        user_cache.clear()
+
+        self.client = app.test_client()
+
+        for i in range(1, 4):
+            db.session.add(User(id=i, username=f"user{i}",
+                                email=f"user{i}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.flush()
+
+        db.session.add(Message(id=1, user_id=2, text="first message",
+                               timestamp=datetime(2020, 1, 1)))
+        db.session.add(Message(id=2, user_id=3, text="second message",
+                               timestamp=datetime(2020, 1, 2)))
+        db.session.flush()
+
+        db.session.add(Follows(user_being_followed_id=2, user_following_id=1))
+        db.session.add(Follows(user_being_followed_id=3, user_following_id=1))
+        db.session.add(Likes(user_id=1, message_id=2))
+        db.session.flush()
+
+        recount()
+        rebuild_timelines()
+        db.session.commit()
+
+    def log_in(self, c):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def test_timeline(self):
+        """Does the timeline list followed users' messages, newest first?"""
+
+        with self.client as c:
+            self.log_in(c)
+
+            with self.assertMaxQueries(4):
+                resp = c.get('/api/timeline')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([msg['text'] for msg in resp.json['messages']],
+                             ["second message", "first message"])
+            self.assertEqual(resp.json['messages'][0]['username'], "user3")
+            self.assertIsNone(resp.json['next_cursor'])
+
+    def test_timeline_fields(self):
+        """Are only the requested fields returned?"""
+
+        with self.client as c:
+            self.log_in(c)
+
+            resp = c.get('/api/timeline?fields=text')
+
+            self.assertEqual(resp.json['messages'][0], {'text': "second message"})
+
+            resp = c.get('/api/timeline?fields=text,password')
+
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json['fields'], ['password'])
+
+    def test_login_required(self):
+        """401 for feeds when logged out?"""
+
+        with self.client as c:
+            resp = c.get('/api/timeline')
+
+            self.assertEqual(resp.status_code, 401)
+
+    def test_users_show(self):
+        """Is a profile public, and its messages included?"""
+
+        with self.client as c:
+            resp = c.get('/api/users/2')
+
+            self.assertEqual(resp.json['user']['username'], "user2")
+            self.assertEqual(resp.json['user']['followers_count'], 1)
+            self.assertNotIn('password', resp.json['user'])
+            self.assertEqual(resp.json['messages'][0]['text'], "first message")
+
+            self.assertEqual(c.get('/api/users/12345678').status_code, 404)
+
+    def test_following_paginated(self):
+        """Are followed users paged with an 'after' cursor?"""
+
+        with self.client as c:
+            self.log_in(c)
+
+            resp = c.get('/api/users/1/following?fields=username')
+
+            self.assertEqual(resp.json['users'],
+                             [{'username': "user2"}, {'username': "user3"}])
+
+            resp = c.get('/api/users/1/following?fields=username&after=2')
+
+            self.assertEqual(resp.json['users'], [{'username': "user3"}])
+
+    def test_followers(self):
+        """Are followers listed?"""
+
+        with self.client as c:
+            self.log_in(c)
+
+            resp = c.get('/api/users/3/followers')
+
+            self.assertEqual([user['id'] for user in resp.json['users']], [1])
+
+    def test_likes(self):
+        """Are liked messages listed?"""
+
+        with self.client as c:
+            self.log_in(c)
+
+            resp = c.get('/api/users/1/likes?fields=id,text')
+
+            self.assertEqual(resp.json['messages'],
+                             [{'id': 2, 'text': "second message"}])
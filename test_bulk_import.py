@@ -0,0 +1,140 @@
+"""Bulk import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_import.py
+
+import csv
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from datetime import datetime
+
+from sqlalchemy import create_engine, inspect
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from bulk_import import import_csvs, import_progress, load_csv
+
+db.create_all()
+
+USERS = [
+    ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url',
+     'location'],
+    ['a@test.com', 'alice', '/a.png', 'HASHED', 'Hi, "all"', '/h.jpg', ''],
+    ['b@test.com', 'bob', '/b.png', 'HASHED', '', '/h.jpg', 'Paris'],
+    ['c@test.com', 'carol', '/c.png', 'HASHED', '', '/h.jpg', ''],
+]
+
+MESSAGES = [
+    ['text', 'timestamp', 'user_id'],
+    ['one, with a comma', '2017-01-01 10:00:00', '1'],
+    ['two', '2017-01-02 10:00:00', '2'],
+    ['three', '2017-01-03 10:00:00', '1'],
+]
+
+FOLLOWS = [
+    ['user_being_followed_id', 'user_following_id'],
+    ['1', '2'],
+    ['1', '3'],
+    ['2', '1'],
+]
+
+
+class BulkImportTestCase(TestCase):
+    """Loading the generator's CSVs."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+        for filename, rows in (('users.csv', USERS),
+                               ('messages.csv', MESSAGES),
+                               ('follows.csv', FOLLOWS)):
+            with open(os.path.join(self.directory.name, filename), 'w',
+                      newline='') as file:
+                csv.writer(file).writerows(rows)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        db.session.rollback()
+
+    def test_import(self):
+        """Rows, ids, counters, timelines and constraints are all in place."""
+
+        import_csvs(self.directory.name, chunk_size=2, report=lambda line: None)
+
+        alice = User.query.get(1)
+        self.assertEqual(alice.username, 'alice')
+        self.assertEqual(alice.bio, 'Hi, "all"')
+        self.assertIsNone(alice.location)
+        self.assertEqual(alice.followers_count, 2)
+        self.assertEqual(alice.messages_count, 2)
+
+        self.assertEqual(Message.query.get(1).text, 'one, with a comma')
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 3)
+
+        # later inserts don't collide with the loaded ids
+        msg = Message(text="new", user_id=2)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.id, 4)
+
+        inspector = inspect(db.engine)
+        self.assertEqual(len(inspector.get_foreign_keys('messages')), 1)
+        self.assertIn('ix_messages_user_id_timestamp',
+                      {index['name'] for index in inspector.get_indexes('messages')})
+
+    def test_resume(self):
+        """A resumed import only loads the rows that weren't committed."""
+
+        import_csvs(self.directory.name, report=lambda line: None)
+
+        # as if the import stopped after the first message
+        Follows.query.delete()
+        Message.query.filter(Message.id > 1).delete()
+        db.session.execute(import_progress.insert(),
+                           [dict(filename='users.csv', rows_loaded=3),
+                            dict(filename='messages.csv', rows_loaded=1)])
+        db.session.commit()
+
+        import_csvs(self.directory.name, resume=True, report=lambda line: None)
+
+        self.assertEqual(User.query.count(), 3)
+        self.assertEqual([msg.text for msg in Message.query.order_by(Message.id)],
+                         ['one, with a comma', 'two', 'three'])
+        self.assertEqual(Follows.query.count(), 3)
+
+    def test_resume_finished(self):
+        """A finished import leaves nothing to resume."""
+
+        import_csvs(self.directory.name, report=lambda line: None)
+
+        with self.assertRaises(ValueError):
+            import_csvs(self.directory.name, resume=True, report=lambda line: None)
+
+    def test_insert_rows(self):
+        """Without COPY, fields are converted to their columns' types."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f"sqlite:///{directory}/import.db")
+            db.metadata.create_all(bind=engine)
+
+            with mock.patch.object(db, 'get_engine', return_value=engine):
+                for table, filename in ((User.__table__, 'users.csv'),
+                                        (Message.__table__, 'messages.csv')):
+                    load_csv(table, os.path.join(self.directory.name, filename),
+                             chunk_size=2, report=lambda line: None)
+
+            rows = engine.execute(Message.__table__.select()
+                                  .order_by(Message.__table__.c.id)).fetchall()
+            engine.dispose()
+
+        self.assertEqual([(row.id, row.timestamp, row.user_id) for row in rows],
+                         [(1, datetime(2017, 1, 1, 10), 1),
+                          (2, datetime(2017, 1, 2, 10), 2),
+                          (3, datetime(2017, 1, 3, 10), 1)])
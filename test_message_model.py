@@ -1,14 +1,18 @@
 """Message model tests."""
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app
+from pagination import paginate_messages
+from search import InvertedIndex
+from indexes import rekey_likes
 
 db.create_all()
 
@@ -81,6 +85,19 @@ class MessageModelTestCase(TestCase):
         self.assertTrue(message)
 
 
+    def test_message_timestamp(self):
+        """Is a new message stamped with when it was posted?"""
+
+        before = datetime.utcnow()
+
+        m = Message(text="just now", user_id=self.user1.id)
+        db.session.add(m)
+        db.session.commit()
+
+        self.assertGreaterEqual(m.timestamp, before)
+        self.assertLessEqual(m.timestamp, datetime.utcnow())
+
+
     def test_message_associates_with_user(self):
         """Is message associated with user?"""
 
@@ -122,4 +139,94 @@ class MessageModelTestCase(TestCase):
             db.session.add(m)
             
         except exc.DataError:
-            pass
\ No newline at end of file
+            pass
+
+
+    def test_paginate_messages(self):
+        """Do cursors page through messages newest first?"""
+
+        for i in range(3):
+            db.session.add(Message(text=f"page {i}", user_id=self.user1.id))
+        db.session.commit()
+
+        query = Message.query.filter_by(user_id=self.user1.id)
+
+        first, cursor = paginate_messages(query, Message.timestamp, Message.id, limit=3)
+
+        self.assertEqual(len(first), 3)
+        self.assertIsNotNone(cursor)
+
+        second, cursor = paginate_messages(query, Message.timestamp, Message.id,
+                                           before=cursor, limit=3)
+
+        self.assertEqual(len(second), 1)
+        self.assertIsNone(cursor)
+        self.assertNotIn(second[0], first)
+
+
+    def test_toggle_like(self):
+        """Does toggling a like add it, then remove it?"""
+
+        message = Message.query.filter_by(user_id=self.user2.id).first()
+
+        self.assertEqual(Likes.toggle(self.user1.id, message.id), 1)
+        self.assertEqual(Likes.query.filter_by(user_id=self.user1.id).count(), 1)
+
+        self.assertEqual(Likes.toggle(self.user1.id, message.id), -1)
+        self.assertEqual(Likes.query.filter_by(user_id=self.user1.id).count(), 0)
+
+
+    def test_duplicate_like(self):
+        """Fail adding the same like twice?"""
+
+        message = Message.query.filter_by(user_id=self.user2.id).first()
+
+        db.session.add(Likes(user_id=self.user1.id, message_id=message.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user1.id, message_id=message.id))
+
+        self.assertRaises(exc.IntegrityError, db.session.commit)
+
+
+    def test_rekey_likes(self):
+        """Are an old likes table's duplicates removed and its key replaced?"""
+
+        message = Message.query.filter_by(user_id=self.user2.id).first()
+        db.session.commit()
+
+        # likes as they were, keyed on an id, with nothing stopping repeats
+        db.session.execute("ALTER TABLE likes DROP CONSTRAINT likes_pkey")
+        db.session.execute("ALTER TABLE likes ADD COLUMN id SERIAL PRIMARY KEY")
+        db.session.execute("ALTER TABLE likes ALTER COLUMN user_id DROP NOT NULL")
+
+        for user_id in (self.user1.id, self.user1.id, self.user2.id, None):
+            db.session.execute("INSERT INTO likes (user_id, message_id) "
+                               "VALUES (:user_id, :message_id)",
+                               dict(user_id=user_id, message_id=message.id))
+
+        db.session.commit()
+
+        self.assertTrue(rekey_likes())
+        self.assertFalse(rekey_likes())
+
+        self.assertEqual(sorted(like.user_id for like in Likes.query),
+                         sorted([self.user1.id, self.user2.id]))
+        self.assertEqual(Likes.toggle(self.user1.id, message.id), -1)
+        self.assertEqual(Likes.toggle(self.user1.id, message.id), 1)
+
+
+    def test_inverted_index(self):
+        """Does the in-process index find, and forget, messages by prefix?"""
+
+        index = InvertedIndex()
+        index.add(1, "Spotted two herons today")
+        index.add(2, "Here comes the heat")
+
+        self.assertEqual(index.search("her"), {1, 2})
+        self.assertEqual(index.search("her spot"), {1})
+
+        index.remove(1)
+
+        self.assertEqual(index.search("her"), {2})
+        self.assertEqual(index.search("spot"), set())
@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +21,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from user_cache import user_cache
+from fragments import card_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -41,7 +43,8 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
-
+        user_cache.clear()
+        card_cache.clear()
 
         self.client = app.test_client()
 
@@ -75,6 +78,43 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+            self.assertEqual(User.query.get(self.testuser.id).messages_count, 1)
+
+
+    def test_add_message_reaches_followers(self):
+        """Is a new message fanned out to followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        db.session.commit()
+
+        follower_id = follower.id
+
+        db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                               user_following_id=follower_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            msg = Message.query.one()
+            entries = TimelineEntry.query.filter_by(message_id=msg.id).all()
+
+            self.assertEqual({e.user_id for e in entries},
+                             {self.testuser.id, follower_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+
+            self.assertIn("Hello", str(resp.data))
+
 
     def test_add_message_invalid_user(self):
         """Can use add a message with invalid user?"""
@@ -122,6 +162,34 @@ class MessageViewTestCase(TestCase):
             self.assertIn(m.text, str(html))
 
 
+    def test_search_messages(self):
+        """Search messages by word prefix?"""
+
+        db.session.add(Message(text="Spotted two herons today", user_id=self.testuser.id))
+        db.session.add(Message(text="Nothing to report", user_id=self.testuser.id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=HER spot")
+
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertIn("Spotted two herons today", str(resp.data))
+
+            self.assertNotIn("Nothing to report", str(resp.data))
+
+
+    def test_search_messages_no_match(self):
+        """View if search matches no messages?"""
+
+        with self.client as c:
+            resp = c.get("/messages/search?q=pelican")
+
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertIn("Sorry, no messages found", str(resp.data))
+
+
     def test_view_invalid_message(self):
         """Show invalid message?"""
 
@@ -157,6 +225,45 @@ class MessageViewTestCase(TestCase):
             self.assertNotIn(m.text, str(html))
 
 
+    def test_show_message_not_modified(self):
+        """304 if the client already has the message page?"""
+
+        db.session.add(Message(id=1, text="Test Message", user_id=self.testuser.id))
+        db.session.commit()
+
+        with self.client as c:
+            etag = c.get('/messages/1').headers['ETag']
+
+            resp = c.get('/messages/1', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the page looks different when logged in
+            resp = c.get('/messages/1', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+
+
+    def test_delete_message_drops_cached_card(self):
+        """Is a deleted message's card dropped from the fragment cache?"""
+
+        db.session.add(Message(id=1, text="Test Message", user_id=self.testuser.id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get("/users/1")
+            self.assertIn(1, card_cache)
+
+            c.post("/messages/1/delete")
+            self.assertNotIn(1, card_cache)
+
+
     def test_delete_message_invalid_user(self):
         """Delete message with invalid user?"""
 
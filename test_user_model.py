@@ -6,7 +6,7 @@
 
 
 import os
-from unittest import TestCase
+from unittest import TestCase, mock
 from sqlalchemy import exc
 
 from models import db, User, Message, Follows
@@ -22,6 +22,10 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app
+from counters import recount
+from indexes import add_missing_columns
+from passwords import (password_hasher, PasswordHasher, PasswordHasherBusy,
+                       get_default_workers)
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -133,6 +137,25 @@ class UserModelTestCase(TestCase):
 
         self.assertIn('testuser1', str(user2.followers))
 
+    def test_is_following_methods(self):
+        """Do is_following / is_followed_by / get_following_ids agree?"""
+
+        user1 = User.query.filter_by(username="testuser1").first()
+        user2 = User.query.filter_by(username="testuser2").first()
+
+        self.assertFalse(user1.is_following(user2))
+
+        follow = Follows(user_being_followed_id=user2.id, user_following_id=user1.id)
+
+        db.session.add(follow)
+        db.session.commit()
+
+        self.assertTrue(user1.is_following(user2))
+        self.assertTrue(user2.is_followed_by(user1))
+        self.assertFalse(user2.is_following(user1))
+        self.assertEqual(user1.get_following_ids(), {user2.id})
+        self.assertEqual(user2.get_following_ids(), set())
+
     def test_signup_user(self):
         """Created user?"""
 
@@ -184,4 +207,93 @@ class UserModelTestCase(TestCase):
     def test_authenticate_incorrect_password(self):
         """Fail authentication when incorrect password?"""
 
-        user = User.authenticate(username="testuser1", password="INVALID")
\ No newline at end of file
+        user = User.authenticate(username="testuser1", password="INVALID")
+
+
+    def test_authenticate_rehashes_on_cost_change(self):
+        """Is the password rehashed at the new cost when logging in?"""
+
+        rounds = password_hasher.rounds
+        password_hasher.rounds = 4
+
+        try:
+            user = User.authenticate(username="testuser1", password="password")
+        finally:
+            password_hasher.rounds = rounds
+
+        self.assertTrue(user.password.startswith("$2b$04$"))
+        self.assertTrue(User.authenticate(username="testuser1", password="password"))
+
+
+    def test_password_hasher_busy(self):
+        """Are hashes refused once the queue is full?"""
+
+        hasher = PasswordHasher()
+        hasher.init_app(app)
+        hasher.workers = 0
+        hasher.queue_timeout = 0
+
+        for _ in range(hasher.max_pending):
+            hasher.slots.acquire()
+
+        with self.assertRaises(PasswordHasherBusy):
+            hasher.hash("password")
+
+
+    def test_password_hasher_threads(self):
+        """Do web processes split the CPUs between their hashing threads?"""
+
+        with mock.patch('os.cpu_count', return_value=8):
+            with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '4'}):
+                self.assertEqual(get_default_workers(), 2)
+
+            with mock.patch.dict(os.environ, {'WEB_CONCURRENCY': '16'}):
+                self.assertEqual(get_default_workers(), 1)
+
+        hasher = PasswordHasher()
+        hasher.workers = 2
+        hashed = hasher.hash("password")
+
+        self.assertTrue(hasher.check(hashed, "password"))
+        self.assertFalse(hasher.check(hashed, "wrong"))
+        hasher.shutdown()
+
+
+    def test_recount(self):
+        """Does recount repair drifted counters?"""
+
+        user1 = User.query.filter_by(username="testuser1").first()
+        user2 = User.query.filter_by(username="testuser2").first()
+
+        db.session.add(Follows(user_being_followed_id=user2.id, user_following_id=user1.id))
+        db.session.add(Message(text="counted", user_id=user1.id))
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 0)
+
+        recount()
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 1)
+        self.assertEqual(user1.following_count, 1)
+        self.assertEqual(user2.followers_count, 1)
+        self.assertEqual(user2.following_count, 0)
+
+
+    def test_add_missing_columns(self):
+        """Are counters added to a users table from before they existed?"""
+
+        user1 = User.query.filter_by(username="testuser1").first()
+        db.session.add(Message(text="counted", user_id=user1.id))
+        db.session.commit()
+
+        db.session.execute("ALTER TABLE users DROP COLUMN messages_count")
+        db.session.commit()
+
+        self.assertEqual(add_missing_columns(), ['users.messages_count'])
+        self.assertEqual(add_missing_columns(), [])
+
+        recount()
+        db.session.commit()
+
+        self.assertEqual(user1.messages_count, 1)
@@ -1,21 +1,37 @@
 """User View tests."""
 
 import os
+import tempfile
+import time
 from typing import Type
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from models import db, connect_db, Message, User, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 from app import app, CURR_USER_KEY
+from timeline import stats as timeline_stats, rebuild_timelines
+from counters import recount
+from testing import QueryBudgetMixin
+from instrumentation import find_repeated_statements
+from user_cache import user_cache
+from ratelimit import login_limiter, DatabaseBucketStore, stats as rate_limit_stats
+from fragments import card_cache, stats as fragment_stats
+from dbpool import is_statement_timeout
+from indexes import find_seq_scans
+from search import (search_users_trigram, search_users_ngram,
+                    create_search_indexes, has_trigram_support)
+from sqlalchemy.exc import OperationalError
+from flask_sqlalchemy import get_state
+from replicas import READ_PRIMARY_KEY
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserViewTestCase(TestCase):
+class UserViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for users."""
 
     def setUp(self):
@@ -25,6 +41,9 @@ class UserViewTestCase(TestCase):
         Message.query.delete()
         Follows.query.delete()
         Likes.query.delete()
+        user_cache.clear()
+        login_limiter.reset()
+        card_cache.clear()
 
         self.client = app.test_client()
 
@@ -52,7 +71,9 @@ class UserViewTestCase(TestCase):
         db.session.add(message1)
         db.session.add(follow1)
         db.session.add(follow2)
+        db.session.flush()
 
+        recount()
         db.session.commit()
 
     
@@ -67,6 +88,108 @@ class UserViewTestCase(TestCase):
             self.assertIn("@testuser", str(resp.data))
 
 
+    def test_user_lists_skip_password_hashes(self):
+        """Do user lists load card columns only, not password hashes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for url in ['/users', '/users?q=user2', '/users/1/following',
+                        '/users/1/followers']:
+                with self.assertMaxQueries(5) as statements:
+                    resp = c.get(url)
+
+                self.assertIn("@testuser2", str(resp.data))
+                self.assertFalse([sql for sql in statements
+                                  if 'users.password' in sql], url)
+
+
+    def test_list_users_after_cursor(self):
+        """Does the 'after' cursor skip users already shown?"""
+
+        with self.client as c:
+            resp = c.get('/users?after=1')
+
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertIn("@testuser2", str(resp.data))
+
+            self.assertNotIn('href="/users/1"', str(resp.data))
+
+
+    def test_search_users(self):
+        """Search users by part of their username?"""
+
+        with self.client as c:
+            resp = c.get('/users?q=user2')
+
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertIn("@testuser2", str(resp.data))
+
+            self.assertNotIn('href="/users/1"', str(resp.data))
+
+
+    def test_search_users_by_bio(self):
+        """Search users by bio, ignoring case?"""
+
+        user = User.query.get(2)
+        user.bio = "Birdwatcher from Oakland"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/users?q=BIRDWATCH')
+
+            self.assertIn("@testuser2", str(resp.data))
+
+            self.assertNotIn('href="/users/1"', str(resp.data))
+
+
+    def test_search_users_ranked(self):
+        """Closest username match first?"""
+
+        with self.client as c:
+            resp = c.get('/users?q=testuser')
+
+            html = str(resp.data)
+
+            self.assertLess(html.index('href="/users/1"'),
+                            html.index('href="/users/2"'))
+
+
+    def test_search_users_trigram(self):
+        """Does the pg_trgm search find and rank users?"""
+
+        create_search_indexes()
+
+        if not has_trigram_support():
+            self.skipTest("pg_trgm isn't installed on this server")
+
+        users = search_users_trigram("testuser", 0, 10)
+
+        self.assertEqual([user.username for user in users],
+                         ["testuser", "testuser2"])
+
+
+    def test_search_users_ngram(self):
+        """Does the in-process index search, and fall back for short searches?"""
+
+        self.assertEqual([user.username for user in search_users_ngram("user2", 0, 10)],
+                         ["testuser2"])
+        self.assertEqual({user.username for user in search_users_ngram("r2", 0, 10)},
+                         {"testuser2"})
+
+
+    def test_search_users_no_match(self):
+        """View if search matches no users?"""
+
+        with self.client as c:
+            resp = c.get('/users?q=nobody')
+
+            self.assertIn("<h3>Sorry, no users found</h3>", str(resp.data))
+
+
     def test_list_users_if_none(self):
         """View if no users?"""
 
@@ -91,6 +214,236 @@ class UserViewTestCase(TestCase):
         self.assertIn("@testuser", str(resp.data))
 
 
+    def test_show_user_details_not_modified(self):
+        """304 for an unchanged profile, 200 once the user posts?"""
+
+        with self.client as c:
+            resp = c.get('/users/2')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+
+            resp = c.get('/users/2', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            db.session.add(Message(user_id=2, text="another message"))
+            db.session.commit()
+
+            resp = c.get('/users/2', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("another message", str(resp.data))
+
+
+    def test_static_files_fingerprinted(self):
+        """Are static files linked by fingerprint and cached for good?"""
+
+        with self.client as c:
+            html = c.get('/').data.decode()
+
+            start = html.index('/static/stylesheets/style.css?v=')
+            url = html[start:html.index('"', start)]
+
+            resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+            resp = c.get('/users')
+
+            self.assertIn('no-store', resp.headers['Cache-Control'])
+
+
+    def add_authors(self, num_authors):
+        """Add users who each post a message that testuser follows and likes."""
+
+        for i in range(num_authors):
+            author = User(username=f"author{i}", email=f"author{i}@test.com",
+                          password="HASHED_PASSWORD")
+            db.session.add(author)
+            db.session.flush()
+
+            msg = Message(text=f"message from author{i}", user_id=author.id)
+            db.session.add(msg)
+            db.session.flush()
+
+            db.session.add(Follows(user_being_followed_id=author.id, user_following_id=1))
+            db.session.add(Likes(user_id=1, message_id=msg.id))
+
+        recount()
+        rebuild_timelines()
+        db.session.commit()
+
+
+    def test_homepage_query_budget(self):
+        """Does the homepage load message authors without a query each?"""
+
+        self.add_authors(5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertMaxQueries(5):
+                resp = c.get('/')
+
+            self.assertIn("@author4", str(resp.data))
+
+
+    def test_show_user_likes_query_budget(self):
+        """Does the likes page load message authors without a query each?"""
+
+        self.add_authors(5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertMaxQueries(5):
+                resp = c.get('/users/1/likes')
+
+            self.assertIn("@author4", str(resp.data))
+
+
+    def test_metrics(self):
+        """Does /metrics count the statements each route runs?"""
+
+        self.add_authors(5)
+
+        headers = {'Authorization': 'Bearer metrics-token'}
+
+        with mock.patch.dict(app.config, METRICS_TOKEN='metrics-token'), self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            before = c.get('/metrics', headers=headers).json['routes'].get('homepage')
+            c.get('/')
+            after = c.get('/metrics', headers=headers).json['routes']['homepage']
+
+            requests = before['requests'] if before else 0
+            n_plus_one = before['n_plus_one_requests'] if before else 0
+
+            self.assertEqual(after['requests'], requests + 1)
+            self.assertGreater(after['statements'], 0)
+            self.assertEqual(after['n_plus_one_requests'], n_plus_one)
+            self.assertIn('reads', c.get('/metrics', headers=headers).json['timeline'])
+
+
+    def test_metrics_hidden(self):
+        """Is /metrics hidden from requests without the token?"""
+
+        with mock.patch.dict(app.config, METRICS_TOKEN='metrics-token'), self.client as c:
+            self.assertEqual(c.get('/metrics').status_code, 404)
+            self.assertEqual(c.get('/metrics', headers={'Authorization': 'Bearer guess'}).status_code, 404)
+
+        with self.client as c:
+            self.assertEqual(c.get('/metrics').status_code, 404)
+
+
+    def test_hot_query_plans(self):
+        """Can every hot query be answered from an index?"""
+
+        self.add_authors(5)
+
+        # tables this small are cheapest to seq scan, so rule that out to
+        # see whether each query has an index to use at all
+        db.session.execute("SET LOCAL enable_seqscan = off")
+        self.assertEqual(find_seq_scans(), {})
+        db.session.rollback()
+
+
+    def test_check_query_plans_without_data(self):
+        """Does the plan check explain itself on an empty database?"""
+
+        User.query.delete()
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['check-query-plans'])
+
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("seed the database first", result.output)
+
+
+    def test_pool_stats(self):
+        """Is the pool configured from app config, and its use shown?"""
+
+        with mock.patch.dict(app.config, METRICS_TOKEN='metrics-token'), self.client as c:
+            self.assertEqual(c.get('/pool/stats').status_code, 404)
+
+            stats = c.get('/pool/stats',
+                          headers={'Authorization': 'Bearer metrics-token'}).json
+
+        self.assertEqual(stats['pool'], 'QueuePool')
+        self.assertEqual(stats['size'], app.config['DB_POOL_SIZE'])
+        self.assertGreater(stats['checkouts'], 0)
+        self.assertTrue(db.engine.pool._pre_ping)
+
+
+    def test_statement_timeouts(self):
+        """Do requests get their route's statement timeout?"""
+
+        with app.test_request_context('/messages/search'):
+            timeout = db.session.execute("SHOW statement_timeout").scalar()
+            db.session.rollback()
+
+        self.assertEqual(timeout, '10s')
+
+        with mock.patch.dict(app.config, STATEMENT_TIMEOUT_MS=50):
+            with app.test_request_context('/'):
+                with self.assertRaises(OperationalError) as context:
+                    db.session.execute("SELECT pg_sleep(1)")
+
+                db.session.rollback()
+
+        self.assertTrue(is_statement_timeout(context.exception))
+
+        # the timeout doesn't outlive the transaction
+        self.assertEqual(db.session.execute("SHOW statement_timeout").scalar(), '0')
+
+
+    def test_message_cards_cached(self):
+        """Are message cards rendered once and then reused?"""
+
+        self.add_authors(5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/')
+            hits = fragment_stats['hits']
+            resp = c.get('/users/1/likes')
+
+            self.assertEqual(fragment_stats['hits'], hits + 5)
+            self.assertIn("message from author4", str(resp.data))
+
+
+    def test_message_cards_follow_profile_edits(self):
+        """Do cached cards show the author's new image after an edit?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            c.get('/users/2')
+            c.post('/users/profile', data={"username": "testuser2", "password": "testuser2", "email": "test2@test2.com", "image_url": "/static/images/new-pic.png"})
+
+            resp = c.get('/users/2')
+
+            self.assertIn('src="/static/images/new-pic.png" alt="" class="timeline-image"', str(resp.data))
+
+
+    def test_find_repeated_statements(self):
+        """Are statements repeated within a request flagged as N+1s?"""
+
+        statements = ["SELECT users WHERE id = %(id)s"] * 5 + ["SELECT 1"] * 2
+
+        self.assertEqual(find_repeated_statements(statements),
+                         {"SELECT users WHERE id = %(id)s": 5})
+
+
     def test_invalid_user_details(self):
         """404 if invalid user?"""
 
@@ -113,6 +466,31 @@ class UserViewTestCase(TestCase):
 
             self.assertIn("Unfollow", str(resp.data))
 
+    def test_show_user_following_paginated(self):
+        """Are followed users paged by id, with follow buttons in one query?"""
+
+        self.add_authors(5)
+        author_ids = [user.id for user in (User.query
+                                           .filter(User.username.like('author%'))
+                                           .order_by(User.id))]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            with self.assertMaxQueries(4):
+                resp = c.get(f"/users/1/following?after={author_ids[2]}")
+
+            html = str(resp.data)
+
+            self.assertNotIn("@author2", html)
+            self.assertIn("@author3", html)
+            self.assertIn("@author4", html)
+
+            # testuser2 follows testuser, but none of the authors
+            self.assertEqual(html.count(">Unfollow<"), 1)
+
+
     def test_show_user_following_invalid_user(self):
         """Show unauthorized if invalid user for user following?"""
 
@@ -238,6 +616,99 @@ class UserViewTestCase(TestCase):
             self.assertIn("testuser2", str(resp.data))
 
 
+    def test_add_follow_backfills_timeline(self):
+        """Does following a user add their messages to my homepage?"""
+
+        Follows.query.delete()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2')
+
+            resp = c.get('/')
+
+            self.assertIn("test message", str(resp.data))
+
+
+    def test_celebrity_messages_merged_on_read(self):
+        """Are messages from high-follower accounts merged into my homepage?"""
+
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                merged_reads = timeline_stats['merged_reads']
+
+                resp = c.get('/')
+
+                self.assertIn("test message", str(resp.data))
+
+                self.assertEqual(timeline_stats['merged_reads'],
+                                 merged_reads + 1)
+
+        finally:
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+
+
+    def test_homepage_streamed(self):
+        """Is the homepage streamed, with merged messages shown once each?"""
+
+        self.add_authors(5)
+
+        app.config['STREAM_HOMEPAGE'] = True
+        app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 1
+
+        try:
+            with self.client as c, mock.patch('app.MESSAGES_PAGE_SIZE', 3):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                resp = c.get('/')
+                html = resp.get_data(as_text=True)
+
+                # ends the stream's request context now, not when the
+                # generator is garbage-collected during a later test
+                resp.close()
+
+                # streamed responses can't know their length up front
+                self.assertNotIn('Content-Length', resp.headers)
+                self.assertEqual(html.count('class="message-area"'), 3)
+                self.assertEqual(html.count("message from author4"), 1)
+                self.assertIn("older-link", html)
+
+        finally:
+            app.config['STREAM_HOMEPAGE'] = False
+            app.config['TIMELINE_CELEBRITY_THRESHOLD'] = 10000
+
+
+    def test_add_follow_updates_counts(self):
+        """Does following update both users' counters?"""
+
+        Follows.query.delete()
+        recount()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2')
+
+            self.assertEqual(User.query.get(1).following_count, 1)
+            self.assertEqual(User.query.get(2).followers_count, 1)
+
+            c.post('/users/stop-following/2')
+
+            self.assertEqual(User.query.get(1).following_count, 0)
+            self.assertEqual(User.query.get(2).followers_count, 0)
+
+
     def test_add_follow_invalid_user(self):
         """Show unauthorized if invalid user for add follow?"""
 
@@ -280,6 +751,24 @@ class UserViewTestCase(TestCase):
             self.assertIsNone(follow)
 
 
+    def test_unfollow_purges_timeline(self):
+        """Does unfollowing remove their messages from my homepage?"""
+
+        Follows.query.delete()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/follow/2')
+            c.post('/users/stop-following/2')
+
+            resp = c.get('/')
+
+            self.assertNotIn("test message", str(resp.data))
+
+
     def test_invalid_unfollow(self):
         """Error if invalid follow?"""
 
@@ -358,6 +847,126 @@ class UserViewTestCase(TestCase):
 
             self.assertIn("Updated", str(resp.data))
 
+    def test_current_user_cached(self):
+        """Is the logged-in user reused across requests without a query?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/users/profile')
+
+            with self.assertMaxQueries(0):
+                resp = c.get('/messages/new')
+
+            self.assertIn("testuser", str(resp.data))
+
+
+    def test_update_user_profile_invalidates_cache(self):
+        """Does the next page show the edited profile?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/users/profile')
+            c.post('/users/profile', data={"username": "testuser", "password": "testuser", "email": "test@test.com", "image_url": "/static/images/new-pic.png"})
+
+            resp = c.get('/messages/new')
+
+            self.assertIn('src="/static/images/new-pic.png"', str(resp.data))
+
+    def test_login(self):
+        """Can log in?"""
+
+        with self.client as c:
+            resp = c.post('/login', data={"username": "testuser", "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 302)
+
+
+    def test_login_rate_limited(self):
+        """Are repeated guesses at one username refused before hashing?"""
+
+        rejected = rate_limit_stats['rejected_by_username']
+
+        with self.client as c:
+            for _ in range(5):
+                resp = c.post('/login', data={"username": "testuser", "password": "wrongpassword"})
+
+                self.assertIn("Invalid credentials", str(resp.data))
+
+            resp = c.post('/login', data={"username": "TESTUSER", "password": "testuser"})
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertIn("Too many login attempts", str(resp.data))
+            self.assertEqual(rate_limit_stats['rejected_by_username'], rejected + 1)
+
+
+    def test_login_success_not_limited(self):
+        """Do successful logins leave the rate limits alone?"""
+
+        with self.client as c:
+            for _ in range(10):
+                resp = c.post('/login', data={"username": "testuser", "password": "testuser"})
+
+                self.assertEqual(resp.status_code, 302)
+
+
+    def test_replica_reads(self):
+        """Are reads sent to a replica, except for a while after a write?"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.dict(app.config,
+                                 REPLICA_BINDS=['replica0'],
+                                 SQLALCHEMY_BINDS={'replica0': f"sqlite:///{directory}/replica.db"}):
+                replica = db.get_engine(app, bind='replica0')
+                db.metadata.create_all(bind=replica)
+                replica.execute(User.__table__.insert(),
+                                username="replicauser",
+                                email="replica@test.com",
+                                password="HASHED_PASSWORD")
+
+                with self.client as c:
+                    html = str(c.get('/users').data)
+                    self.assertIn("@replicauser", html)
+                    self.assertNotIn("@testuser", html)
+
+                    # a post, e.g. a failed login, writes to the primary...
+                    c.post('/login', data={"username": "testuser", "password": "wrongpassword"})
+
+                    # ...which the user's next requests read from
+                    for _ in range(2):
+                        html = str(c.get('/users').data)
+                        self.assertIn("@testuser", html)
+                        self.assertNotIn("@replicauser", html)
+
+                    # until the replicas have had time to catch up
+                    with c.session_transaction() as sess:
+                        sess[READ_PRIMARY_KEY] = time.time() - 1
+
+                    self.assertIn("@replicauser", str(c.get('/users').data))
+
+                replica.dispose()
+                get_state(app).connectors.pop('replica0', None)
+
+
+    def test_database_bucket_store(self):
+        """Does the shared store refuse once a bucket is empty?"""
+
+        store = DatabaseBucketStore()
+        store.clear()
+
+        self.assertTrue(store.take("ip:10.0.0.1", 2, 0.001))
+        self.assertTrue(store.take("ip:10.0.0.1", 2, 0.001))
+        self.assertFalse(store.take("ip:10.0.0.1", 2, 0.001))
+        self.assertTrue(store.take("ip:10.0.0.2", 2, 0.001))
+
+        store.give("ip:10.0.0.1", 2)
+
+        self.assertTrue(store.take("ip:10.0.0.1", 2, 0.001))
+        self.assertFalse(store.take("ip:10.0.0.1", 2, 0.001))
+
     def test_update_user_profile_incorrect_password(self):
         """Unquthorized if wrong password?"""
 
@@ -392,6 +1001,21 @@ class UserViewTestCase(TestCase):
             self.assertIsNone(user)
 
 
+    def test_delete_user_updates_counts(self):
+        """Does deleting a user update the counters of related users?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/users/delete')
+
+            user2 = User.query.get(2)
+
+            self.assertEqual(user2.followers_count, 0)
+            self.assertEqual(user2.following_count, 0)
+
+
     def test_delete_user_no_user(self):
         """Unauthorized if no user for delete user?"""
 
@@ -424,6 +1048,8 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(len(user.likes), 1)
 
+            self.assertEqual(user.likes_count, 1)
+
 
     def test_unlike(self):
         """Unlike?"""
@@ -448,6 +1074,8 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(len(user.likes), 0)
 
+            self.assertEqual(user.likes_count, 0)
+
             
     
     def test_add_like_no_user(self):
@@ -0,0 +1,28 @@
+"""Helpers shared by Warbler's tests."""
+
+from contextlib import contextmanager
+
+from instrumentation import count_queries
+from models import db
+
+
+class QueryBudgetMixin:
+    """Adds `assertMaxQueries` to a TestCase."""
+
+    @contextmanager
+    def assertMaxQueries(self, max_queries):
+        """Fail if the block runs more than `max_queries` SQL statements.
+
+        Use like:
+
+            with self.assertMaxQueries(5):
+                c.get('/')
+        """
+
+        with count_queries(db.engine) as statements:
+            yield statements
+
+        self.assertLessEqual(
+            len(statements), max_queries,
+            f"{len(statements)} queries run, budget was {max_queries}:\n"
+            + "\n\n".join(statements))
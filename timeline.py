@@ -0,0 +1,267 @@
+"""Precomputed home timelines for Warbler.
+
+Every user's home timeline is kept as rows in `timeline_entries`. Rows are
+written when a message is posted (fan-out-on-write) and when a follow is
+added or removed, so the homepage reads a ready-made list of message ids
+instead of scanning the messages of everyone the user follows.
+
+Fanning out is skipped for "celebrity" accounts, those with at least
+TIMELINE_CELEBRITY_THRESHOLD followers, since a single post would mean a
+write per follower. Their recent messages are merged into followers'
+timelines at read time instead.
+
+None of these functions commit; callers commit along with the change that
+caused them.
+"""
+
+import heapq
+from collections import Counter
+
+from sqlalchemy import literal
+from sqlalchemy.orm import joinedload
+
+from models import db, User, Follows, Message, TimelineEntry
+from pagination import (MESSAGES_PAGE_SIZE, page_of, page_query,
+                        encode_message_cursor)
+
+# How many of a newly-followed user's messages get copied into the
+# follower's timeline.
+TIMELINE_LENGTH = 100
+
+# Default follower count at which an account stops being fanned out on write;
+# override with the TIMELINE_CELEBRITY_THRESHOLD app config setting.
+CELEBRITY_THRESHOLD = 10000
+
+# Counters for this process: how many homepage reads there were, how many of
+# those had to merge in celebrity messages, and how many posts were / were
+# not fanned out.
+stats = Counter()
+
+
+def get_celebrity_threshold():
+    """Return the follower count at which accounts are merged on read."""
+
+    # db.get_app() rather than current_app, so this also works from scripts
+    # like seed.py that run outside an app context
+    return db.get_app().config.get('TIMELINE_CELEBRITY_THRESHOLD',
+                                   CELEBRITY_THRESHOLD)
+
+
+def is_celebrity(user_id):
+    """Is `user_id` followed by too many users to fan out to?"""
+
+    followers_count = (db.session
+                       .query(User.followers_count)
+                       .filter(User.id == user_id)
+                       .scalar())
+
+    return (followers_count or 0) >= get_celebrity_threshold()
+
+
+def get_followed_celebrity_ids(user):
+    """Return ids of the celebrity accounts that `user` follows."""
+
+    followed = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user.id))
+
+    celebrities = (db.session
+                   .query(User.id)
+                   .filter(User.id.in_(followed),
+                           User.followers_count >= get_celebrity_threshold()))
+
+    return [user_id for (user_id,) in celebrities]
+
+
+def fan_out_message(msg):
+    """Deliver `msg` to its author's timeline and to all of their followers.
+
+    Celebrity messages only go to the author's own timeline. `msg` must
+    already be flushed so that it has an id.
+    """
+
+    db.session.add(TimelineEntry(user_id=msg.user_id,
+                                 message_id=msg.id,
+                                 timestamp=msg.timestamp))
+
+    if is_celebrity(msg.user_id):
+        stats['fan_outs_skipped'] += 1
+        return
+
+    stats['fan_outs'] += 1
+
+    followers = (db.select([Follows.user_following_id,
+                            literal(msg.id, db.Integer),
+                            literal(msg.timestamp, db.DateTime)])
+                 .where(Follows.user_being_followed_id == msg.user_id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], followers))
+
+
+def remove_message(msg):
+    """Remove `msg` from every timeline it was delivered to."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == msg.id)
+     .delete(synchronize_session=False))
+
+
+def backfill_timeline(follower_id, followed_id):
+    """Copy the recent messages of `followed_id` into `follower_id`'s timeline.
+
+    Nothing is copied for celebrities, whose messages are merged on read.
+    """
+
+    if is_celebrity(followed_id):
+        return
+
+    recent = (db.select([literal(follower_id, db.Integer),
+                         Message.id,
+                         Message.timestamp])
+              .where(Message.user_id == followed_id)
+              .order_by(Message.timestamp.desc())
+              .limit(TIMELINE_LENGTH))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], recent))
+
+
+def purge_timeline(follower_id, followed_id):
+    """Remove all of `followed_id`'s messages from `follower_id`'s timeline."""
+
+    followed_messages = (db.session
+                         .query(Message.id)
+                         .filter(Message.user_id == followed_id))
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == follower_id,
+             TimelineEntry.message_id.in_(followed_messages))
+     .delete(synchronize_session=False))
+
+
+def message_query(columns=None):
+    """Return a query for messages along with their authors.
+
+    By default it returns Message objects with `user` loaded, since pages
+    show the author of every message. With `columns` (columns of Message
+    and User, including ones labeled "id" and "timestamp" for ordering),
+    it returns plain rows of just those columns.
+    """
+
+    if columns is None:
+        return Message.query.options(joinedload(Message.user))
+
+    return (db.session
+            .query(*columns)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id))
+
+
+def get_home_timeline(user, before=None, limit=MESSAGES_PAGE_SIZE):
+    """Return a page of `user`'s home timeline and the cursor for the next.
+
+    Messages from followed celebrities are merged in here, since they were
+    never fanned out. `before` is a cursor from a previous page (see
+    pagination.py).
+    """
+
+    messages = list(iter_home_timeline(user, before=before, limit=limit))
+
+    return page_of(messages, limit, encode_message_cursor)
+
+
+def iter_home_timeline(user, before=None, limit=MESSAGES_PAGE_SIZE,
+                       batch_size=None, columns=None):
+    """Yield a page of `user`'s home timeline, plus one, newest first.
+
+    Like get_home_timeline, but rows are yielded as they're read. With
+    `batch_size`, they're fetched from the database that many at a time
+    (with a server-side cursor on PostgreSQL), so the first rows can be
+    used before the last have been read.
+
+    With `columns` (see message_query), rows of those columns are yielded
+    instead of Message objects.
+    """
+
+    stats['reads'] += 1
+
+    timeline = page_query((message_query(columns)
+                           .join(TimelineEntry,
+                                 TimelineEntry.message_id == Message.id)
+                           .filter(TimelineEntry.user_id == user.id)),
+                          TimelineEntry.timestamp,
+                          TimelineEntry.message_id,
+                          before=before,
+                          limit=limit)
+
+    celebrity_ids = get_followed_celebrity_ids(user)
+
+    if batch_size:
+        timeline = timeline.yield_per(batch_size)
+
+    if not celebrity_ids:
+        yield from timeline
+        return
+
+    stats['merged_reads'] += 1
+
+    celebrity_messages = page_query((message_query(columns)
+                                     .filter(Message.user_id.in_(celebrity_ids))),
+                                    Message.timestamp,
+                                    Message.id,
+                                    before=before,
+                                    limit=limit)
+
+    if batch_size:
+        celebrity_messages = celebrity_messages.yield_per(batch_size)
+
+    merged = heapq.merge(timeline, celebrity_messages,
+                         key=lambda msg: (msg.timestamp, msg.id),
+                         reverse=True)
+
+    # an account may have been fanned out to before it became a celebrity,
+    # so the same message can come back from both queries (next to itself,
+    # since both are in the same order)
+    last_id = None
+    count = 0
+
+    for msg in merged:
+        if msg.id != last_id:
+            yield msg
+            count += 1
+
+            if count > limit:
+                return
+
+        last_id = msg.id
+
+
+def rebuild_timelines():
+    """Rebuild every user's timeline from the follows and messages tables.
+
+    Used after bulk loads (see seed.py), which bypass fan-out. As with
+    fan-out, celebrity messages only go to their author's timeline, so
+    follower counts must be up to date (see counters.recount).
+    """
+
+    TimelineEntry.query.delete(synchronize_session=False)
+
+    celebrities = (db.select([User.id])
+                   .where(User.followers_count >= get_celebrity_threshold()))
+
+    own = db.select([Message.user_id, Message.id, Message.timestamp])
+
+    followed = (db.select([Follows.user_following_id,
+                           Message.id,
+                           Message.timestamp])
+                .where(Follows.user_being_followed_id == Message.user_id)
+                .where(Message.user_id.notin_(celebrities)))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], own.union_all(followed)))
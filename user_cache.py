@@ -0,0 +1,110 @@
+"""A short-lived cache of logged-in users' profile fields.
+
+Every request needs `g.user`, but most only use a few columns of it (the
+nav bar shows the username and avatar; the homepage shows the counters).
+`get_current_user` serves those columns from an in-process cache for up to
+USER_CACHE_TTL seconds, as a `CachedUser`. Anything else (relationships,
+the password hash, model methods) loads the full User on first use.
+
+The cache is per process. Routes that change a user call
+`invalidate_user`, which keeps this process current; other processes may
+show the old values until their copy expires.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, User
+
+# Default seconds a cached user is trusted; override with the USER_CACHE_TTL
+# app config setting.
+USER_CACHE_TTL = 10
+
+# Most users cached at once, oldest evicted first
+USER_CACHE_SIZE = 10000
+
+CACHED_FIELDS = ('id', 'username', 'email', 'image_url', 'header_image_url',
+                 'bio', 'location', 'messages_count', 'following_count',
+                 'followers_count', 'likes_count')
+
+# {user_id: (expires_at, fields)}
+user_cache = OrderedDict()
+user_cache_lock = threading.Lock()
+
+
+class CachedUser:
+    """The cached fields of a User, standing in for it as `g.user`.
+
+    Other attributes are read from the full User, loaded on first use. To
+    change or delete the user, work on `load()`'s result instead.
+    """
+
+    # these only need the id, so they shouldn't load the full User
+    get_following_ids = User.get_following_ids
+    get_liked_message_ids = User.get_liked_message_ids
+
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    def __repr__(self):
+        return f"<CachedUser #{self.id}: {self.username}, {self.email}>"
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def load(self):
+        """Return the full User, loading it on first use."""
+
+        if '_user' not in self.__dict__:
+            self._user = User.query.get(self.id)
+
+        return self._user
+
+
+def get_cache_ttl():
+    """Return how many seconds cached users are trusted for."""
+
+    return db.get_app().config.get('USER_CACHE_TTL', USER_CACHE_TTL)
+
+
+def get_user_fields(user_id):
+    """Return {field: value} for `user_id` from the database, or None."""
+
+    columns = [getattr(User, field) for field in CACHED_FIELDS]
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+
+    return dict(zip(CACHED_FIELDS, row)) if row else None
+
+
+def get_current_user(user_id):
+    """Return a CachedUser for `user_id`, or None if there's no such user."""
+
+    now = time.monotonic()
+
+    with user_cache_lock:
+        expires_at, fields = user_cache.get(user_id, (0, None))
+
+    if expires_at <= now:
+        fields = get_user_fields(user_id)
+
+        if fields is None:
+            invalidate_user(user_id)
+            return None
+
+        with user_cache_lock:
+            user_cache[user_id] = (now + get_cache_ttl(), fields)
+            user_cache.move_to_end(user_id)
+
+            if len(user_cache) > USER_CACHE_SIZE:
+                user_cache.popitem(last=False)
+
+    return CachedUser(fields)
+
+
+def invalidate_user(*user_ids):
+    """Drop the cached fields of `user_ids`, e.g. after they change."""
+
+    with user_cache_lock:
+        for user_id in user_ids:
+            user_cache.pop(user_id, None)